@@ -10,9 +10,21 @@ try:
     import re
     import shutil
     import calendar
+    import json
+    import socket
+    import threading
+    import queue
+    import warnings
+    import http.server
+    import urllib.parse
+    import copy
+    import uuid
+    import concurrent.futures
     from calendar import monthrange
+    from xml.sax import saxutils
 except ModuleNotFoundError as b:
-    print('ModuleNotFoundError: Missing basic libraries (required: glob, os, sys, time, datetime, re, shutil, calendar')
+    print('ModuleNotFoundError: Missing basic libraries (required: glob, os, sys, time, datetime, re, shutil, '
+          'calendar, json, socket, threading, queue, warnings, xml, http, urllib, copy, uuid, concurrent')
     print(b)
 
 # import additional python libraries
@@ -24,6 +36,16 @@ except ModuleNotFoundError as b:
     print('ModuleNotFoundError: Missing fundamental packages (required: gdal, numpy, pandas')
     print(b)
 
+# import optional python libraries (only needed to read batch files in TOML or YAML format, see sysl_batch.py)
+try:
+    import tomllib  # Python 3.11 or newer
+except ModuleNotFoundError:
+    tomllib = None
+try:
+    import yaml
+except ModuleNotFoundError:
+    yaml = None
+
 """Input variable description: * Decision variables 
 - start_date, end_date: strings, in yyyymm (YearMonth) format, which determine the range of dates to analyze. If they 
 are the same, only one month will be analyzed. - calc_bed_load: boolean, if 'True' then the bed load is calculated 
@@ -39,11 +61,23 @@ and added to the results table for each subcatchment.
 - p_path: string, path for the support practice factor (.tif format)
 - tt_path: string, path for the travel time raster (.tif format)
 
+* Time-varying factor rasters
+    *Any factor (C, K, P, LS) can be given as a date-indexed series of rasters, which are used before the input
+    rasters above. Each entry is a tuple (start, end, path): start and end in YYYYMM format set a validity period, in
+    MM format a period which recurs every year (e.g. ('10', '03', path) from October to March) and None all months.
+- factor_schedule: dictionary, with the factor name ('C', 'K', 'P', 'LS') as key and a list of (start, end, path)
+                   entries as value.
+- factor_cache_mb: float, maximum memory (in MB) of the time-varying factor arrays and C*K*P*LS products kept in memory.
+                  Time-invariant factor arrays and their partial product are always kept and are not included.
+
 * RFactor rasters
     *Folder where the 'monthly' RFactor rasters (in .tif) format are located. There should be one raster for each month
     to be analyzed. The file name must include the year-month of the raster data in the format YYYYMM
 - R_folder: string, folder path with .tif files 
 
+- prefetch_depth: int, number of R factor rasters which are read ahead on a background thread while the current month
+                  is calculated (0 = no prefetching).
+
 * Clipping shapes:
     *files must be in *.shp format and have the same projection as the input rasters. 
     *Each file name must be in the format Catchment_NAME.shp
@@ -53,10 +87,62 @@ and added to the results table for each subcatchment.
               
 * Results folder
 - results_path: path,  string, path where to save the resulting SY, SL, and Total SL results for each catchment. 
+- output_mode: string, 'clip' to clip the total catchment rasters to each catchment with gdalwarp (.tif files) or 'vrt'
+               to save virtual rasters (.vrt files) for each catchment, which read the window of the catchment from the
+               total catchment rasters, multiplied with a cached cutline mask.
 
 * Calculation constants
 - beta: float, coefficient which was calibrated for the catchment (see Ferro and Porto (2000))
 - pixel_area = float, area of a single raster pixel (in ha)
+
+* Long-term statistics
+- temporal_statistics: boolean, if True the mean, standard deviation, maximum, threshold exceedance frequency and
+                       (optionally) quantiles of the SL and SY of each pixel over the analysis period are saved to the
+                       'Statistics' folder in the results folder. The accumulators take about 56 bytes per pixel (plus
+                       4 per threshold and 120 per quantile), so they are off by default.
+- statistics_thresholds: dictionary, with 'SL' and 'SY' as keys and a list of thresholds as values, for which the
+                         frequency of months above the threshold is calculated.
+- statistics_quantiles: list, quantiles (in %) estimated for each pixel with the P-square algorithm (empty = none).
+
+* Zonal query service (sysl_query.py)
+- query_variables: list, variables of the total catchment ('SL', 'SY') whose monthly rasters are stacked for queries.
+- query_port: int, port of the HTTP query service on localhost.
+- query_cache_mb: float, maximum memory (in MB) of the cache of rasterized query polygons.
+
+* Batch of study areas (sysl_batch.py)
+- batch_file: string, path of the .json, .toml or .yaml file with the settings of each basin (see sysl_batch.py).
+- batch_workers: int, number of worker processes shared by all basins (0 = one for each CPU).
+- batch_memory_mb: float, memory (in MB) which the running jobs can use, estimated from the raster size of each basin
+                   (0 = 80 % of the physical memory).
+
+* Sharded execution (sysl_sharding.py)
+- queue_path: string, folder path on a file system shared by all nodes, where the work units, leases and partial results
+              are saved.
+- months_per_unit: int, number of months (R factor rasters) in each work unit.
+- catchments_per_unit: int, number of clipping shapes in each work unit. If 0, all shapes are in one work unit.
+- lease_time: float, time (in seconds) after which a lease of a work unit that was not renewed is considered expired and
+              the work unit can be claimed by another worker.
+
+* Ensemble (sysl_ensemble.py)
+- n_members: int, number of ensemble members.
+- ensemble_seed: int, seed of the random number generators.
+- r_noise_cv: float, coefficient of variation of the multiplier of the R factor, which is the same for all pixels and
+              is drawn for each member and month (0 = no perturbation).
+- beta_sd: float, standard deviation of the beta coefficient (0 = calibrated beta for all members).
+- k_noise_cv, c_noise_cv: float, coefficient of variation of the multipliers of the K and C factors, which are the same
+                          for all pixels and months of a member (0 = no perturbation).
+- r_pixel_noise_cv, k_pixel_noise_cv, c_pixel_noise_cv: float, coefficient of variation of the independent noise of each
+                          pixel of the R, K and C factors (0 = no pixel noise).
+- ensemble_quantiles: list, quantiles (in %) to save for each sub-catchment.
+- ensemble_batch_size: int, maximum number of values (members x pixels) which are calculated at once.
+- ensemble_pixel_quantiles: boolean, if True a raster with the SY quantiles is saved for each month.
+
+* Land management scenarios (sysl_scenarios.py)
+- scenarios: dictionary, with the name of each scenario (key) and a dictionary (value) with the paths of its C factor
+             ('cp_path' or 'c_winter_path' and 'c_summer_path') and P factor ('p_path') rasters. Factors which are not
+             set use the input rasters above.
+- scenario_rasters: dictionary, with the name of a scenario (key) and a list of the rasters to save for the total
+                    catchment ('SL', 'SY', 'SY_Total'). Scenarios which are not in the dictionary save no rasters.
 """
 # Dates
 start_date = '201605'
@@ -67,7 +153,7 @@ seasonal_cfactor = True
 # Import input rasters:
 k_path = r''
 ls_path = r''
-p_path = r'
+p_path = r''
 tt_path = r''
 
 if seasonal_cfactor:
@@ -77,15 +163,67 @@ if seasonal_cfactor:
 else:
     cp_path = r''
 
+# Time-varying factor rasters:
+factor_schedule = {
+    # 'C': [('01', '01', r''), ('02', '02', r''), ...],  # monthly C factor, recurring every year
+    # 'P': [('201601', '201612', r''), ('201701', '201712', r'')],  # yearly P factor
+}
+factor_cache_mb = 1024
+
 # Rfactor rasters:
 r_folder = r''
+prefetch_depth = 1
 
 # Clipping shape:
 clip_path = r''
 
 # Results:
 results_path = r''
+output_mode = 'clip'
 
 # Calculation constants:
 beta = 0.5639
 pixel_area = 0.0625  # in hectares (ha)
+
+# Long-term statistics:
+temporal_statistics = False
+statistics_thresholds = {'SL': [], 'SY': []}
+statistics_quantiles = []
+
+# Zonal query service:
+query_variables = ['SL', 'SY']
+query_port = 8765
+query_cache_mb = 256
+
+# Batch of study areas:
+batch_file = r''
+batch_workers = 0
+batch_memory_mb = 0
+
+# Sharded execution:
+queue_path = r''
+months_per_unit = 12
+catchments_per_unit = 0
+lease_time = 3600  # in seconds
+
+# Ensemble:
+n_members = 500
+ensemble_seed = 42
+r_noise_cv = 0.2
+beta_sd = 0.05
+k_noise_cv = 0.0
+c_noise_cv = 0.0
+r_pixel_noise_cv = 0.0
+k_pixel_noise_cv = 0.0
+c_pixel_noise_cv = 0.0
+ensemble_quantiles = [5, 50, 95]
+ensemble_batch_size = 20000000
+ensemble_pixel_quantiles = False
+
+# Land management scenarios:
+scenarios = {
+    'Current': {},
+    # 'Reforestation': {'cp_path': r''},
+    # 'Terracing': {'p_path': r''},
+}
+scenario_rasters = {}
@@ -0,0 +1,446 @@
+"""
+Module runs the model for several study areas (basins) in one batch, in which the months of all basins are calculated
+on one shared pool of worker processes.
+
+Usage:
+    python sysl_batch.py [batch_file]   -> runs all basins of the batch file (default: batch_file in config.py)
+
+The batch file (.json, .toml or .yaml) contains the settings of each basin, with the same names as the input variables
+in config.py. Settings in 'defaults' apply to all basins and settings which are not set use the values of config.py:
+
+    {"defaults": {"start_date": "201605", "end_date": "201804"},
+     "basins": [{"name": "Banja", "r_folder": "...", "results_path": "...", "beta": 0.5639, ...},
+                {"name": "Devoll", "r_folder": "...", "results_path": "...", "seasonal_cfactor": false, ...}]}
+
+Notes:
+* The input rasters of each basin are checked when its jobs are created (the user is asked whether to continue if
+    their projections are different). The run of each basin is split into jobs: a 'prepare' job (saves the SDR raster
+    and the masks), 'months' jobs with months_per_unit months each (SL, SY and total SY rasters and rows of the summary
+    array) and a 'finish' job (summary tables and long-term statistics of the basin). The months jobs of a basin start
+    when its prepare job is finished, and the finish job when all its months jobs are finished.
+* Since the input variables are module-level variables (from config import *), each job first sets the settings of its
+    basin in config.py and in all sysl modules loaded by the worker process (see function 'apply_settings').
+* The memory of each job is estimated from the number of pixels of the basin rasters. Jobs are only started while the
+    estimated memory of the running jobs stays below batch_memory_mb (the largest jobs are started first). A job which
+    is larger than batch_memory_mb is started when no other job is running.
+* The long-term statistics of each pixel (temporal_statistics) are calculated in the finish job from the saved total
+    catchment rasters, since the months of a basin are calculated in several processes.
+* If a job of a basin fails, the remaining jobs of the basin are cancelled and the other basins continue. If a worker
+    process terminates abruptly (e.g. killed when the memory runs out), the pool is started again and the jobs which
+    were running are started once more. A job which is running when the pool breaks a second time fails its basin.
+* The batch report (batch file name + '_report.txt') contains the status, number of months, estimated memory, compute
+    time and errors of each basin. It is also saved if the batch run stops early.
+"""
+import config
+import sysl_factor_schedule as fs
+import sysl_file_management as fm
+import sysl_main as sysl
+import sysl_raster_calculations as rc
+import sysl_statistics as st
+from config import *
+
+SETTING_TYPES = (str, int, float, bool, list, dict, tuple)
+BASE_SETTINGS = {name: copy.deepcopy(value) for name, value in vars(config).items()
+                 if not name.startswith('_') and isinstance(value, SETTING_TYPES)}
+OPTIONAL_SETTINGS = ['cp_path', 'c_winter_path', 'c_summer_path']  # Only one C factor input is set in config.py
+JOB_RETRIES = 1  # Times a job is started again after the pool broke while it was running
+
+# Factors of the last basin calculated by the worker process, which are reused by the next job of the same basin
+worker_state = {'basin': None, 'factors': None, 'gt': None, 'proj': None, 'windows': None}
+
+
+def read_batch_file(batch_file):
+    """
+    Function reads the settings of each basin from the batch file and completes them with the 'defaults' of the batch
+    file and the input variables of config.py.
+
+    :param batch_file: string, path of the batch file (.json, .toml, .yaml or .yml)
+
+    :return: list, with a dictionary with the settings of each basin (including its 'name')
+
+    Note: the function generates an ERROR if the format is not supported, if a setting is not an input variable of
+    config.py, if a basin has no name or if two basins have the same name or results_path.
+    """
+    extension = os.path.splitext(batch_file)[1].lower()
+    if not os.path.exists(batch_file):
+        sys.exit("ERROR: The batch file " + batch_file + " does not exist.")
+    if extension == '.json':
+        with open(batch_file) as f:
+            batch = json.load(f)
+    elif extension == '.toml':
+        if tomllib is None:
+            sys.exit("ERROR: TOML batch files need Python 3.11 or newer. Use a .json batch file.")
+        with open(batch_file, 'rb') as f:
+            batch = tomllib.load(f)
+    elif extension in ['.yaml', '.yml']:
+        if yaml is None:
+            sys.exit("ERROR: YAML batch files need the pyyaml package. Use a .json batch file.")
+        with open(batch_file) as f:
+            batch = yaml.safe_load(f)
+    else:
+        sys.exit("ERROR: The batch file must be a .json, .toml or .yaml file.")
+
+    basins = []
+    for basin in batch.get('basins', []):
+        settings = copy.deepcopy(BASE_SETTINGS)
+        settings.update(batch.get('defaults', {}))
+        settings.update(basin)
+        unknown = [name for name in settings if name not in BASE_SETTINGS and name not in OPTIONAL_SETTINGS + ['name']]
+        if len(unknown) > 0:
+            sys.exit("ERROR: The following settings of the batch file are not input variables of config.py: " +
+                     ", ".join(unknown))
+        if 'name' not in settings:
+            sys.exit("ERROR: Each basin of the batch file needs a 'name'.")
+        basins.append(settings)
+
+    if len(basins) == 0:
+        sys.exit("ERROR: The batch file " + batch_file + " has no basins.")
+    for key in ['name', 'results_path']:
+        values = [os.path.abspath(basin[key]) if key == 'results_path' else basin[key] for basin in basins]
+        if len(set(values)) != len(values):
+            sys.exit("ERROR: Each basin of the batch file needs a different " + key + ".")
+    return basins
+
+
+def apply_settings(settings):
+    """
+    Function sets the settings of a basin as module-level variables of config.py and of all loaded sysl modules, which
+    copied the input variables with 'from config import *'. Optional settings which the basin does not set (e.g.
+    cp_path of a basin with a seasonal C factor) are removed, so the values of the last basin are not used.
+
+    :param settings: dictionary, with the settings of the basin (from function 'read_batch_file')
+    """
+    modules = [module for name, module in list(sys.modules.items()) if name == 'config' or name.startswith('sysl_')]
+    if sys.modules[__name__] not in modules:  # Module run as __main__
+        modules.append(sys.modules[__name__])
+    for name, value in settings.items():
+        if name == 'name':
+            continue
+        for module in modules:
+            setattr(module, name, copy.deepcopy(value))
+    for name in OPTIONAL_SETTINGS:
+        if name not in settings:
+            for module in modules:
+                if hasattr(module, name):
+                    delattr(module, name)
+
+
+def get_memory_limit(memory_mb):
+    """
+    Function gets the memory (in MB) which the running jobs can use.
+
+    :param memory_mb: float, memory set by the user. If 0, 80 % of the physical memory is used (if it can be read)
+
+    :return: float, memory in MB (np.inf if there is no limit)
+    """
+    if memory_mb > 0:
+        return memory_mb
+    try:
+        return 0.8 * os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (ValueError, AttributeError, OSError):  # os.sysconf is not available on all systems
+        return np.inf
+
+
+def estimate_job_memory(settings, kind, n_pixels, n_catchments):
+    """
+    Function estimates the memory (in MB) of a job from the number of pixels of the basin rasters.
+
+    :param settings: dictionary, with the settings of the basin
+    :param kind: string, 'prepare', 'months' or 'finish'
+    :param n_pixels: int, number of pixels of the basin rasters
+    :param n_catchments: int, number of clipping shapes of the basin
+
+    :return: float, estimated memory in MB
+    """
+    array_mb = n_pixels * rc.PIXEL_BYTES / 1024 ** 2  # Masked float32 array
+    masks_mb = n_pixels * (n_catchments + 1) / 1024 ** 2 if settings['output_mode'] == 'vrt' else 0
+    if kind == 'prepare':  # TT, SDR and the catchment masks
+        return 2 * array_mb + masks_mb
+    if kind == 'months':  # TT, SDR, R factor arrays (read and prefetched), SL, SY, total SY and the factor arrays
+        # Time-invariant factors and their partial product are kept for the whole job (see sysl_factor_schedule), the
+        # time-varying factor rasters and the static products of the months are kept in the factor cache
+        schedule = {factor: [tuple(entry) for entry in settings['factor_schedule'].get(factor, [])] + [(None, None, '')]
+                    for factor in fs.FACTORS}  # Same entries as function 'get_factor_schedule'
+        if settings['seasonal_cfactor']:
+            schedule['C'][-1:] = [('10', '03', ''), ('04', '09', '')]
+        varying = fs.get_varying_factors(schedule)
+        pinned_mb = (len(fs.FACTORS) - len(varying) + 1) * array_mb if len(varying) < len(fs.FACTORS) else 0
+        n_rasters = sum(len(schedule[factor]) for factor in varying) + settings['months_per_unit']
+        cache_mb = min(settings['factor_cache_mb'], n_rasters * array_mb) if len(varying) > 0 else 0
+        return (6 + settings['prefetch_depth']) * array_mb + pinned_mb + cache_mb + masks_mb
+    if settings['temporal_statistics']:  # One accumulator (see sysl_statistics) and the prefetched rasters
+        n_thresholds = max([len(values) for values in settings['statistics_thresholds'].values()] + [0])
+        acc_bytes = 8 * (3 + 15 * len(settings['statistics_quantiles'])) + 4 * (1 + n_thresholds)
+        return n_pixels * acc_bytes / 1024 ** 2 + (2 + settings['prefetch_depth']) * array_mb
+    return 0
+
+
+def plan_basin_jobs(settings):
+    """
+    Function gets the input files of a basin, checks its input rasters and creates its jobs. The input rasters are
+    checked in the main process, since the worker processes cannot ask the user whether to continue if the projections
+    are different (see sysl_raster_calculations.check_input_rasters).
+
+    :param settings: dictionary, with the settings of the basin
+
+    :return: dictionary with the 'prepare' job, list with the 'months' jobs and dictionary with the 'finish' job
+    """
+    start = fm.get_date(settings['start_date'])
+    end = fm.get_date(settings['end_date'])
+    r_filenames, clip_filenames = sysl.get_input_files(settings['r_folder'], settings['clip_path'], start, end)
+    apply_settings(settings)
+    schedule = fs.get_factor_schedule(factor_schedule)
+    rc.check_input_rasters([r_filenames[0], tt_path] + fs.get_schedule_paths(schedule), pixel_area)
+    n_pixels = int(np.prod(rc.get_raster_size(settings['tt_path'])))
+
+    basin = {'settings': settings, 'name': settings['name'], 'r_files': r_filenames, 'clip_files': clip_filenames}
+    prepare = dict(basin, kind='prepare', rows=[],
+                   memory=estimate_job_memory(settings, 'prepare', n_pixels, len(clip_filenames)))
+    months = []
+    n_months = max(int(settings['months_per_unit']), 1)
+    for row in range(0, len(r_filenames), n_months):
+        rows = list(range(row, min(row + n_months, len(r_filenames))))
+        months.append(dict(basin, kind='months', rows=rows,
+                           memory=estimate_job_memory(settings, 'months', n_pixels, len(clip_filenames))))
+    finish = dict(basin, kind='finish', rows=[],
+                  memory=estimate_job_memory(settings, 'finish', n_pixels, len(clip_filenames)))
+    return prepare, months, finish
+
+
+def get_basin_factors(job):
+    """
+    Function gets the factors of the basin of a job, which are kept by the worker process for the next job of the same
+    basin.
+
+    :param job: dictionary with the job data (see function 'plan_basin_jobs')
+
+    :return: dictionary with the factors (see sysl_main.read_factors), GEOTransform tuple, projection tuple and list
+    with the catchment windows (None if output_mode is not 'vrt')
+    """
+    if worker_state['basin'] != job['name']:
+        worker_state.update({'basin': None, 'factors': None, 'windows': None})  # Release the factors of the last basin
+        # The input rasters were checked when the jobs were created and the SDR raster was saved by the prepare job
+        factors, gt, proj = sysl.read_factors(job['r_files'][0], save_sdr=False, interactive=False)
+        if output_mode == 'vrt':  # Cutline masks were saved by the prepare job
+            windows = sysl.get_catchment_windows(job['clip_files'], gt, proj, factors['TT'].shape)
+        else:
+            windows = None
+        worker_state.update({'basin': job['name'], 'factors': factors, 'gt': gt, 'proj': proj, 'windows': windows})
+    return worker_state['factors'], worker_state['gt'], worker_state['proj'], worker_state['windows']
+
+
+def run_job(job, data=None, dates=None):
+    """
+    Function runs one job of a basin in a worker process.
+
+    :param job: dictionary with the job data (see function 'plan_basin_jobs')
+    :param data: 3D np.array with the summary results of the basin (only for the 'finish' job)
+    :param dates: np.array with the dates of the basin (only for the 'finish' job)
+
+    :return: dictionary with the 'rows', 'data' and 'dates' calculated by the job, the factor rasters read ('reads')
+    and the compute 'time' (in seconds)
+    """
+    start_time = time.time()
+    apply_settings(job['settings'])
+    result = {'rows': job['rows'], 'data': None, 'dates': [], 'reads': {}}
+
+    if job['kind'] == 'prepare':
+        fm.check_folder(results_path, additional_folders=False)
+        sysl.create_result_folders(job['clip_files'])  # Before the months jobs save their results
+        factors, gt, proj = sysl.read_factors(job['r_files'][0], save_sdr=True, interactive=False)
+        if output_mode == 'vrt':
+            sysl.get_catchment_windows(job['clip_files'], gt, proj, factors['TT'].shape)
+
+    elif job['kind'] == 'months':
+        factors, gt, proj, windows = get_basin_factors(job)
+        reads = dict(factors['cache']['reads'])
+        result['data'] = sysl.create_summary_array(len(job['clip_files']), len(job['rows']))
+        total_path = os.path.join(results_path, "Total")
+        i = 0
+        for file, R_array in rc.prefetch_rasters([job['r_files'][row] for row in job['rows']], prefetch_depth):
+            result['dates'].append(sysl.calculate_month(file, i, result['data'], factors, job['clip_files'], gt, proj,
+                                                        total_path, R_array, catchment_windows=windows))
+            i += 1
+        result['reads'] = {path: n - reads.get(path, 0) for path, n in factors['cache']['reads'].items()
+                           if n > reads.get(path, 0)}
+
+    elif job['kind'] == 'finish':
+        sysl.save_summary_tables(data, dates, job['clip_files'])
+        if temporal_statistics:
+            st.save_result_statistics(results_path, [date[0] for date in dates], statistics_thresholds,
+                                      statistics_quantiles, prefetch_depth)
+
+    result['time'] = time.time() - start_time
+    return result
+
+
+def cancel_basin(name, error, report, ready, waiting):
+    """
+    Function marks a basin as failed and removes its jobs which were not started yet.
+
+    :param name: string, name of the basin
+    :param error: string, with the error of the basin
+    :param report: dictionary, with the report of each basin
+    :param ready: list, with the jobs which can be started (modified in place)
+    :param waiting: dictionary, with the months and finish jobs of each basin
+    """
+    print("Basin", name, "failed:", error)
+    report[name].update({'Status': 'failed', 'Error': error})
+    ready[:] = [job for job in ready if job['name'] != name]
+    waiting[name]['months'] = []
+
+
+def run_batch(basins, n_workers, memory_mb, report_path):
+    """
+    Function runs the jobs of all basins on one pool of worker processes and saves the batch report, also if the run
+    stops early (the basins which were not finished are 'stopped').
+
+    :param basins: list, with the settings of each basin (from function 'read_batch_file')
+    :param n_workers: int, number of worker processes (if 0, one for each CPU)
+    :param memory_mb: float, memory (in MB) which the running jobs can use (see function 'get_memory_limit')
+    :param report_path: string, file path (including name.txt) with which to save the batch report
+
+    :return: list, with a dictionary with the report of each basin
+    """
+    start_time = time.time()
+    n_workers = n_workers if n_workers > 0 else os.cpu_count()
+    memory_mb = get_memory_limit(memory_mb)
+    print("Batch of", len(basins), "basins with", n_workers, "workers and", memory_mb, "MB")
+
+    ready = []  # Jobs whose previous jobs are finished
+    waiting = {}  # Months and finish jobs of each basin
+    report = {}
+    pool = None
+    try:
+        for settings in basins:
+            name = settings['name']
+            report[name] = {'Basin': name, 'Status': 'running', 'Months': 0, 'Jobs': 0, 'Memory per job [MB]': 0.0,
+                            'Compute time [s]': 0.0, 'Finished after [s]': np.nan,
+                            'Results': settings['results_path'], 'Error': ''}
+            try:
+                prepare, months, finish = plan_basin_jobs(settings)
+            except SystemExit as error:  # Missing input files: the other basins continue
+                report[name].update({'Status': 'failed', 'Error': str(error)})
+                continue
+            memory = max(job['memory'] for job in [prepare, finish] + months)
+            report[name].update({'Months': len(prepare['r_files']), 'Jobs': len(months) + 2,
+                                 'Memory per job [MB]': round(memory, 1)})
+            ready.append(prepare)
+            waiting[name] = {'months': months, 'finish': finish, 'running': 0, 'data': None, 'dates': None}
+
+        running = {}
+        used_mb = 0
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+        while len(ready) > 0 or len(running) > 0:
+            broken = False  # A worker process terminated abruptly, so no job of the pool can finish
+            # Start the largest jobs which fit into the free memory. If no job is running, the largest job is started.
+            ready.sort(key=lambda job: job['memory'], reverse=True)
+            for job in list(ready):
+                if len(running) >= n_workers:
+                    break
+                if used_mb + job['memory'] <= memory_mb or len(running) == 0:
+                    try:
+                        if job['kind'] == 'finish':
+                            future = pool.submit(run_job, job, waiting[job['name']]['data'],
+                                                 waiting[job['name']]['dates'])
+                        else:
+                            future = pool.submit(run_job, job)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        broken = True
+                        break
+                    running[future] = job
+                    used_mb += job['memory']
+                    ready.remove(job)
+
+            if broken:
+                done = set()
+            else:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = running[future]
+                basin = waiting[job['name']]
+                try:
+                    result = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    broken = True
+                    continue  # The job is started again with the other running jobs
+                except (Exception, SystemExit) as error:  # Cancel the remaining jobs of the basin
+                    running.pop(future)
+                    used_mb -= job['memory']
+                    cancel_basin(job['name'], f"{job['kind']} job: {error}", report, ready, waiting)
+                    continue
+                running.pop(future)
+                used_mb -= job['memory']
+                if report[job['name']]['Status'] == 'failed':
+                    continue  # Another job of the basin failed
+                report[job['name']]['Compute time [s]'] += result['time']
+
+                if job['kind'] == 'prepare':
+                    basin['data'] = np.full((len(job['clip_files']) + 1, len(job['r_files']),
+                                             4 if job['settings']['calc_bed_load'] else 3), np.nan)
+                    basin['dates'] = np.full((len(job['r_files']), 1), "", dtype=object)
+                    ready.extend(basin['months'])
+                    basin['running'] = len(basin['months'])
+                elif job['kind'] == 'months':
+                    basin['data'][:, result['rows'], :] = result['data']
+                    basin['dates'][result['rows'], 0] = result['dates']
+                    basin['running'] -= 1
+                    if basin['running'] == 0:
+                        ready.append(basin['finish'])
+                else:
+                    report[job['name']].update({'Status': 'done', 'Finished after [s]': time.time() - start_time})
+                    print("Basin finished: ", job['name'])
+
+            if broken:  # Start a new pool and start the jobs which were running again
+                print("A worker process terminated abruptly. Restarting the pool with", len(running), "running jobs.")
+                pool.shutdown(wait=True)
+                for job in running.values():
+                    if report[job['name']]['Status'] == 'failed':
+                        continue
+                    job['retries'] = job.get('retries', 0) + 1
+                    if job['retries'] > JOB_RETRIES:
+                        cancel_basin(job['name'], f"{job['kind']} job: a worker process terminated abruptly",
+                                     report, ready, waiting)
+                    else:
+                        ready.append(job)
+                running = {}
+                used_mb = 0
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        for basin_report in report.values():
+            if basin_report['Status'] == 'running':
+                basin_report['Status'] = 'stopped'
+        save_batch_report(list(report.values()), report_path, time.time() - start_time)
+
+    return list(report.values())
+
+
+def save_batch_report(report, save_path, total_time):
+    """
+    Function saves the report of the batch run into a .txt file.
+
+    :param report: list, with a dictionary with the report of each basin (from function 'run_batch')
+    :param save_path: string, file path (including name.txt) with which to save the report
+    :param total_time: float, time (in seconds) of the batch run
+    """
+    df = pd.DataFrame(report)
+    df['Compute time [s]'] = df['Compute time [s]'].round(1)
+    df['Finished after [s]'] = df['Finished after [s]'].round(1)
+    df.to_csv(save_path, index=False, sep='\t', na_rep="")
+    with open(save_path, 'a') as f:
+        f.write(f"\nBasins done: {int((df['Status'] == 'done').sum())} of {len(df)}. Total time [s]: "
+                f"{total_time:.1f}\n")
+    print("Batch report saved: ", save_path)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    if len(sys.argv) > 1:
+        batch_file = sys.argv[1]
+
+    basin_settings = read_batch_file(batch_file)
+    run_batch(basin_settings, batch_workers, batch_memory_mb, os.path.splitext(batch_file)[0] + '_report.txt')
+
+    print('Total time: ', time.time() - start_time)
@@ -0,0 +1,298 @@
+"""
+Module runs a Monte Carlo ensemble of the model to estimate the uncertainty of the monthly soil loss (SL), sediment
+yield (SY) and total SY of each sub-catchment.
+
+Each ensemble member perturbs the model inputs as follows:
+* R factor: log-normal multiplier (mean 1, coefficient of variation r_noise_cv), which is the same for all pixels and
+    drawn for each member and month
+* beta: sample from a normal distribution (mean beta, standard deviation beta_sd), truncated to positive values
+* K and C factors (optional): multiplicative log-normal multipliers (k_noise_cv, c_noise_cv), which are the same for all
+    pixels and months of a member
+* Pixel noise (optional): independent multiplicative log-normal noise of each pixel for the R factor (drawn for each
+    month), K factor and C factor (r_pixel_noise_cv, k_pixel_noise_cv, c_pixel_noise_cv)
+
+The multipliers are spatially uniform, so they are not averaged out in the totals of large catchments. The pixel noise
+is uncorrelated between pixels, so its effect on the catchment totals decreases with the number of pixels (about
+1/sqrt(N)) and it mainly affects the pixel quantiles.
+
+Usage:
+    python sysl_ensemble.py
+
+Notes:
+* All members are evaluated against the same static factor arrays. Each R factor raster is read once and the members
+    are evaluated together in blocks of raster rows, whose size is limited by ensemble_batch_size.
+* No raster is saved for the ensemble members. For each sub-catchment (and the total catchment), only the statistics of
+    each member are kept and a table with their quantiles for each month is saved (NAME_Ensemble.txt).
+* If ensemble_pixel_quantiles is True, rasters with the quantiles of the SY of all members are saved for each month to
+    the 'Ensemble' folder in the results folder.
+* The multipliers are drawn from generators which are seeded with ensemble_seed, the input and the month. The pixel
+    noise is a counter-based hash (SplitMix64) of ensemble_seed, the input, the month, the member and the position of
+    the pixel. Therefore, the results of a run can be reproduced and do not depend on ensemble_batch_size.
+"""
+import sysl_factor_schedule as fs
+import sysl_file_management as fm
+import sysl_functions as r_calc
+import sysl_main as sysl
+import sysl_raster_calculations as rc
+from config import *
+
+
+def lognormal_noise(rng, cv, size):
+    """
+    Function draws a multiplicative log-normal noise field with a mean of 1 and a given coefficient of variation.
+
+    :param rng: np.random.Generator with which to draw the noise
+    :param cv: float, coefficient of variation of the noise
+    :param size: tuple, shape of the noise array
+
+    :return: np.array (float32) with the noise values
+    """
+    sigma = np.sqrt(np.log(1 + cv ** 2))
+    z = rng.standard_normal(size, dtype=np.float32)
+    return np.exp(np.float32(-sigma ** 2 / 2) + np.float32(sigma) * z)
+
+
+def splitmix64(x):
+    """
+    Function mixes 64-bit integers with the SplitMix64 finalizer, which maps consecutive integers to uniformly
+    distributed 64-bit integers.
+
+        Steele, G.L., Lea, D., Flood, C.H., 2014. Fast splittable pseudorandom number generators. ACM SIGPLAN Notices
+        49(10), 453–472. https://doi.org/10.1145/2714064.2660195
+
+    :param x: np.array (uint64) with the integers to mix
+
+    :return: np.array (uint64) with the mixed integers
+    """
+    with np.errstate(over='ignore'):  # The operations are modulo 2^64
+        z = x + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def get_member_keys(seed, kind, month, n_members):
+    """
+    Function gets the key of the pixel noise of each member for an input and month.
+
+    :param seed: int, seed of the ensemble
+    :param kind: int, number of the perturbed input (1: R factor, 2: K factor, 3: C factor)
+    :param month: int, month number in the analysis period (0 for inputs which are the same in all months)
+    :param n_members: int, number of ensemble members
+
+    :return: np.array (uint64) with one key for each member
+    """
+    key = np.full(n_members, seed, dtype=np.uint64)
+    for value in [kind, month]:
+        key = splitmix64(key ^ np.uint64(value))
+    return splitmix64(key ^ np.arange(n_members, dtype=np.uint64))
+
+
+def pixel_noise(keys, cv, index):
+    """
+    Function gets a multiplicative log-normal noise (mean 1) for each member and pixel from a counter-based hash of the
+    member key and the pixel position, so the noise of a pixel does not depend on the other pixels which are drawn at
+    the same time. The normal values are calculated with the Box-Muller transform.
+
+    :param keys: np.array (uint64) with the key of each member (from function 'get_member_keys')
+    :param cv: float, coefficient of variation of the noise
+    :param index: np.array with the position (row * number of columns + column) of each pixel
+
+    :return: np.array (float32) with the noise values of each member (rows) and pixel (columns)
+    """
+    with np.errstate(over='ignore'):
+        counter = keys[:, None] + index.astype(np.uint64)[None, :] * np.uint64(2)
+    u1 = ((splitmix64(counter) >> np.uint64(11)) + 1) * 2.0 ** -53  # (0, 1]
+    u2 = (splitmix64(counter + np.uint64(1)) >> np.uint64(11)) * 2.0 ** -53
+    z = (np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2)).astype(np.float32)
+    sigma = np.sqrt(np.log(1 + cv ** 2))
+    return np.exp(np.float32(-sigma ** 2 / 2) + np.float32(sigma) * z)
+
+
+def sample_beta(n_members, beta_mean, beta_std, seed):
+    """
+    Function samples the beta coefficient for each ensemble member.
+
+    :param n_members: int, number of ensemble members
+    :param beta_mean: float, calibrated beta coefficient
+    :param beta_std: float, standard deviation of the beta coefficient
+    :param seed: int, seed of the random number generator
+
+    :return: np.array (float32) with one beta value for each member
+    """
+    rng = np.random.default_rng([seed, 0])
+    betas = rng.normal(beta_mean, beta_std, n_members)
+    return np.clip(betas, 1e-6, None).astype(np.float32)
+
+
+def calculate_ensemble_month(r_array, static_array, factors, betas, masks, seed, i, batch_size, quantiles):
+    """
+    Function calculates the SL and SY of all ensemble members for one month, and gets the statistics of each member for
+    each watershed and the quantiles of the SY of all members for each pixel.
+
+    :param r_array: np.array with the R factor values for the month
+    :param static_array: np.array with the product of the C, K, P and LS factors for the month
+    :param factors: dictionary with the constant arrays, from function 'read_factors' in sysl_main
+    :param betas: np.array with one beta value for each member
+    :param masks: 3D boolean np.array with the mask of each watershed, from function 'get_catchment_masks' in sysl_main
+    :param seed: int, seed of the random number generators
+    :param i: int, month number in the analysis period
+    :param batch_size: int, maximum number of values (members x pixels) calculated at once
+    :param quantiles: list, with the quantiles (in %) to calculate for each pixel (if None, none are calculated)
+
+    :return: 3 np.arrays, with the mean SL, the sum of SY (total SY) and the number of valid SY pixels of each member
+    (rows) in each watershed (columns), and the np.array with the SY quantiles for each pixel (or None)
+    """
+    n_members = betas.shape[0]
+    n_rows, n_cols = r_array.shape
+    n_masks = masks.shape[0]
+
+    # Static part of the soil loss equation, which is the same for all members (masked pixels are np.nan)
+    sl_base = r_calc.calculate_sl(r_array, static_array).astype(np.float32)
+    tt = factors['TT'].filled(np.nan).astype(np.float32)
+
+    sl_sum = np.zeros((n_members, n_masks))
+    sl_count = np.zeros((n_members, n_masks))
+    sy_sum = np.zeros((n_members, n_masks))
+    sy_count = np.zeros((n_members, n_masks))
+    if quantiles is not None:
+        sy_quantiles = np.full((len(quantiles), n_rows, n_cols), np.nan, dtype=np.float32)
+    else:
+        sy_quantiles = None
+
+    # Multipliers of each member, which are the same for all pixels. The K and C multipliers are the same in every
+    # month: their generators do not depend on the month.
+    multiplier = (lognormal_noise(np.random.default_rng([seed, 1, i]), r_noise_cv, n_members) *
+                  lognormal_noise(np.random.default_rng([seed, 2]), k_noise_cv, n_members) *
+                  lognormal_noise(np.random.default_rng([seed, 3]), c_noise_cv, n_members))
+    # Pixel noise of each input: (cv, member keys)
+    noise = [(cv, get_member_keys(seed, kind, month, n_members))
+             for kind, cv, month in [(1, r_pixel_noise_cv, i), (2, k_pixel_noise_cv, 0), (3, c_pixel_noise_cv, 0)]
+             if cv > 0]
+
+    block_rows = max(1, int(batch_size // (n_members * n_cols)))
+    for row in range(0, n_rows, block_rows):
+        rows = slice(row, min(row + block_rows, n_rows))
+        size = (n_members, sl_base[rows].size)
+
+        # Perturb the soil loss of each member
+        sl = sl_base[rows].ravel()[None, :] * multiplier[:, None]
+        index = np.arange(row * n_cols, row * n_cols + size[1])
+        for cv, keys in noise:
+            sl *= pixel_noise(keys, cv, index)
+
+        # Sediment yield with the SDR of each member's beta value
+        sdr = np.exp(-betas[:, None] * tt[rows].ravel()[None, :])
+        sy = r_calc.calculate_sy(sl, sdr, pixel_area)
+
+        # Statistics of each member in each watershed: sums and valid pixel count
+        block_masks = masks[:, rows, :].reshape(n_masks, -1)
+        block_sum, block_count = r_calc.calculate_mask_sums(sl, block_masks)
+        sl_sum += block_sum
+        sl_count += block_count
+        block_sum, block_count = r_calc.calculate_mask_sums(sy, block_masks)
+        sy_sum += block_sum
+        sy_count += block_count
+
+        if quantiles is not None:
+            with np.errstate(invalid='ignore'):
+                valid_pixels = ~np.isnan(sy).all(axis=0)
+                block_q = np.full((len(quantiles), size[1]), np.nan, dtype=np.float32)
+                block_q[:, valid_pixels] = np.percentile(sy[:, valid_pixels], quantiles, axis=0)
+            sy_quantiles[:, rows, :] = block_q.reshape(len(quantiles), -1, n_cols)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sl_mean = sl_sum / sl_count
+        sy_total = np.where(sy_count > 0, sy_sum, np.nan)
+
+    return sl_mean, sy_total, sy_count, sy_quantiles
+
+
+def run_ensemble(r_filenames, clip_filenames, n_members, seed, batch_size, quantiles, pixel_quantiles):
+    """
+    Function runs the ensemble for all R factor rasters and saves the quantile tables for each watershed.
+
+    :param r_filenames: list, with the R factor raster paths within the analysis date range
+    :param clip_filenames: list, with the shape file paths
+    :param n_members: int, number of ensemble members
+    :param seed: int, seed of the random number generators
+    :param batch_size: int, maximum number of values (members x pixels) calculated at once
+    :param quantiles: list, with the quantiles (in %) to save
+    :param pixel_quantiles: boolean, if True saves a raster with the SY quantiles of all members for each month
+
+    :return: 4D np.array with the quantiles (watershed, month, variable, quantile) and np.array with the dates
+    """
+    factors, gt, proj = sysl.read_factors(r_filenames[0], save_sdr=False)
+    shape = factors['TT'].shape
+    masks = sysl.get_catchment_masks(clip_filenames, gt, shape)
+    betas = sample_beta(n_members, beta, beta_sd, seed)
+
+    n_vars = 4 if calc_bed_load else 3
+    data = np.full((masks.shape[0], len(r_filenames), n_vars, len(quantiles)), np.nan)
+    dates_vector = np.full((len(r_filenames), 1), "", dtype=object)
+    ensemble_path = os.path.join(results_path, "Ensemble")
+    if pixel_quantiles:
+        fm.check_folder(ensemble_path, additional_folders=False)
+
+    i = 0  # loop for every month
+    for file, r_array in rc.prefetch_rasters(r_filenames, prefetch_depth):
+        r_date = str(fm.get_date(file).strftime("%Y%m"))
+        print(r_date)
+        static_array = fs.get_static_factors(factors['schedule'], factors['cache'], r_date)
+
+        sl_mean, sy_total, sy_count, sy_quantiles = calculate_ensemble_month(
+            r_array, static_array, factors, betas, masks, seed, i, batch_size, quantiles if pixel_quantiles else None)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            member_stats = [sl_mean, sy_total / sy_count, sy_total]
+            if calc_bed_load:
+                member_stats.append(r_calc.calculate_bl(sy_total[:, :, None], r_date, axis=2))
+        for v in range(0, n_vars):
+            # Quantiles over the members (axis 0) for each watershed
+            data[:, i, v, :] = np.nanpercentile(member_stats[v], quantiles, axis=0).T
+
+        if pixel_quantiles:
+            for q in range(0, len(quantiles)):
+                save_q = os.path.join(ensemble_path, f'SY_Q{quantiles[q]:g}_{r_date}.tif')
+                rc.save_raster(sy_quantiles[q], save_q, gt, proj)
+
+        dates_vector[i][0] = r_date
+        i += 1
+
+    return data, dates_vector
+
+
+def save_ensemble_tables(data, dates_vector, clip_filenames, quantiles):
+    """
+    Function saves the ensemble quantile table of each watershed.
+
+    :param data: 4D np.array with the quantiles (watershed, month, variable, quantile)
+    :param dates_vector: np.array, with the date for each analyzed month (in string YYYYMM format)
+    :param clip_filenames: list, with the shape file paths which correspond to watersheds 1 to n in data
+    :param quantiles: list, with the quantiles (in %) in data
+    """
+    for k in range(0, int(data.shape[0])):
+        if k == 0:
+            save_path = os.path.join(results_path, "Total")
+            file_name = os.path.join(save_path, "Banja_Ensemble.txt")
+        else:  # for catchments, the file name must be is Catchment_NAME.
+            shape_name = os.path.splitext(os.path.basename(clip_filenames[k - 1])[10:])[0]
+            save_path = os.path.join(results_path, shape_name)
+            file_name = os.path.join(save_path, f'{shape_name}_Ensemble.txt')
+        fm.check_folder(save_path)
+        fm.save_ensemble_table(data, k, dates_vector, quantiles, file_name)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    start_date = fm.get_date(start_date)
+    end_date = fm.get_date(end_date)
+    fm.check_folder(results_path, additional_folders=False)
+
+    R_filenames, clip_filenames = sysl.get_input_files(r_folder, clip_path, start_date, end_date)
+    ensemble_data, dates_vector = run_ensemble(R_filenames, clip_filenames, n_members, ensemble_seed,
+                                               ensemble_batch_size, ensemble_quantiles, ensemble_pixel_quantiles)
+    save_ensemble_tables(ensemble_data, dates_vector, clip_filenames, ensemble_quantiles)
+
+    print('Total time: ', time.time() - start_time)
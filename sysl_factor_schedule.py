@@ -0,0 +1,227 @@
+"""
+Module contains functions to get the time-varying factor rasters (C, P, K and LS) for each analyzed month and to read
+them through a memory-bounded least recently used (LRU) cache.
+
+A factor schedule is a dictionary with the factor name ('C', 'P', 'K', 'LS') as key and a list of entries as value.
+Each entry is a tuple (start, end, path), with which the raster in path is used for the months between start and end
+(both included):
+    - start and end in YYYYMM format: validity period (e.g. ('201601', '201612', P_2016.tif) for yearly P maps)
+    - start and end in MM format: recurring months of every year. If start is after end, the period includes the turn of
+        the year (e.g. ('10', '03', C_winter.tif))
+    - start and end are None: all months
+The first entry of a factor whose period includes the month is used.
+
+Notes:
+* Time-invariant factor rasters (entries with start and end None) and the partial product of the time-invariant factors
+    of a month (e.g. K*P*LS if only the C factor changes) are read or calculated once and kept for the whole run. They
+    are not counted in the cache size.
+* The factor cache keeps the time-varying factor arrays and the static products C*K*P*LS of the month. Least recently
+    used entries are removed when the arrays in the cache take more memory than the cache size, so each time-varying
+    raster is only read again if it was removed from the cache.
+"""
+from collections import OrderedDict
+
+import sysl_functions as r_calc
+import sysl_raster_calculations as rc
+from config import *
+
+FACTORS = ['C', 'K', 'P', 'LS']
+
+
+def get_factor_schedule(schedule=None):
+    """
+    Function creates the factor schedule from the input rasters in config.py. The entries of the input schedule are
+    used first and the input rasters (k_path, ls_path, p_path and cp_path or c_winter_path and c_summer_path) are used
+    for the months which are not included in the input schedule.
+
+    :param schedule: dictionary, with the factor name (key) and a list of (start, end, path) entries (value)
+
+    :return: dictionary, with a list of (start, end, path) entries for each factor in FACTORS
+    """
+    if schedule is None:
+        schedule = {}
+    base = {'K': [(None, None, k_path)], 'P': [(None, None, p_path)], 'LS': [(None, None, ls_path)]}
+    if seasonal_cfactor:  # Winter from October to March, summer from April to September
+        base['C'] = [('10', '03', c_winter_path), ('04', '09', c_summer_path)]
+    else:
+        base['C'] = [(None, None, cp_path)]
+
+    factor_schedule = {}
+    for factor in FACTORS:
+        factor_schedule[factor] = [tuple(entry) for entry in schedule.get(factor, [])] + base[factor]
+    return factor_schedule
+
+
+def get_schedule_paths(schedule):
+    """
+    Function gets the paths of all rasters in a factor schedule.
+
+    :param schedule: dictionary, with a list of (start, end, path) entries for each factor
+
+    :return: list, with the raster paths (without duplicates)
+    """
+    paths = []
+    for factor in FACTORS:
+        for entry in schedule[factor]:
+            if entry[2] not in paths:
+                paths.append(entry[2])
+    return paths
+
+
+def get_varying_factors(schedule):
+    """
+    Function gets the factors whose raster can change from month to month, i.e. whose first entry is not valid for all
+    months.
+
+    :param schedule: dictionary, with a list of (start, end, path) entries for each factor
+
+    :return: list, with the names of the time-varying factors
+    """
+    return [factor for factor in FACTORS if schedule[factor][0][0] is not None and schedule[factor][0][1] is not None]
+
+
+def resolve_factor_paths(schedule, r_date, invariant=None):
+    """
+    Function gets the raster path of each factor for a given month.
+
+    :param schedule: dictionary, with a list of (start, end, path) entries for each factor
+    :param r_date: string, with the date of the month (YYYYMM)
+    :param invariant: list, to which the factors whose raster is valid for all months (start and end None) are added
+
+    :return: dictionary, with the raster path for each factor in FACTORS
+
+    Note: the function generates an ERROR if the schedule of a factor has no entry for the month.
+    """
+    month = r_date[4:6]
+    paths = {}
+    for factor in FACTORS:
+        for start, end, path in schedule[factor]:
+            if start is None or end is None:
+                valid = True
+                if invariant is not None:
+                    invariant.append(factor)
+            elif len(str(start)) == 2:  # Recurring months, MM format
+                if str(start) <= str(end):
+                    valid = str(start) <= month <= str(end)
+                else:  # Period includes the turn of the year
+                    valid = month >= str(start) or month <= str(end)
+            else:  # Validity period, YYYYMM format
+                valid = str(start) <= r_date <= str(end)
+            if valid:
+                paths[factor] = path
+                break
+        if factor not in paths:
+            sys.exit("ERROR: The factor schedule has no " + factor + " raster for " + r_date + ". Check input.")
+    return paths
+
+
+def create_factor_cache(max_mb):
+    """
+    Function creates an empty factor cache.
+
+    :param max_mb: float, maximum memory (in MB) of the arrays in the cache
+
+    :return: dictionary with the cached arrays ('items', ordered from least to most recently used), the time-invariant
+    arrays, which are never removed ('pinned'), the maximum memory of the cached arrays ('max_bytes') and the number of
+    times each raster was read ('reads')
+    """
+    return {'items': OrderedDict(), 'pinned': {}, 'max_bytes': max_mb * 1024 ** 2, 'reads': {}}
+
+
+def get_array_bytes(array):
+    """
+    Function gets the memory of an array, including the mask of masked arrays.
+
+    :param array: np.array or masked np.array, or a tuple which contains np.arrays
+
+    :return: int, memory of the array in bytes
+    """
+    if isinstance(array, tuple):
+        return sum(get_array_bytes(item) for item in array if isinstance(item, (np.ndarray, tuple)))
+    if np.ma.isMaskedArray(array):
+        return array.nbytes + np.ma.getmaskarray(array).nbytes
+    return array.nbytes
+
+
+def add_to_cache(cache, key, array):
+    """
+    Function adds an array to the factor cache and removes the least recently used arrays until the arrays in the
+    cache do not exceed the maximum memory. The added array is never removed, even if it exceeds the maximum memory.
+
+    :param cache: dictionary, from function 'create_factor_cache'
+    :param key: tuple, with which the array is saved
+    :param array: np.array (or masked array) to add
+    """
+    items = cache['items']
+    items[key] = array
+    n_bytes = sum(get_array_bytes(item) for item in items.values())
+    while n_bytes > cache['max_bytes'] and len(items) > 1:
+        old_key, old_array = items.popitem(last=False)
+        n_bytes -= get_array_bytes(old_array)
+
+
+def get_factor_array(cache, path, pinned=False):
+    """
+    Function gets the masked array of a factor raster from the factor cache, or reads it if it is not in the cache.
+
+    :param cache: dictionary, from function 'create_factor_cache'
+    :param path: string, path of the factor raster
+    :param pinned: boolean, if True the array is time-invariant and is kept outside of the least recently used cache
+
+    :return: masked np.array with the factor values
+    """
+    key = ('array', path)
+    if key in cache['pinned']:
+        return cache['pinned'][key]
+    if key in cache['items']:
+        array = cache['items'][key]
+        if pinned:  # Raster of a time-varying entry which is also used by a time-invariant entry
+            del cache['items'][key]
+        else:
+            cache['items'].move_to_end(key)
+    else:
+        array = rc.raster_to_array(path)
+        cache['reads'][path] = cache['reads'].get(path, 0) + 1
+        if not pinned:
+            add_to_cache(cache, key, array)
+    if pinned:
+        cache['pinned'][key] = array
+    return array
+
+
+def get_static_factors(schedule, cache, r_date):
+    """
+    Function gets the static product C*K*P*LS for a given month from the factor cache, or calculates it with the
+    factor rasters of the month if it is not in the cache. The partial product of the time-invariant factors is kept
+    outside of the least recently used cache, so only the time-varying factors are read and multiplied again if the
+    product was removed from the cache.
+
+    :param schedule: dictionary, with a list of (start, end, path) entries for each factor
+    :param cache: dictionary, from function 'create_factor_cache'
+    :param r_date: string, with the date of the month (YYYYMM)
+
+    :return: masked np.array with the product of the C, K, P and LS factors
+    """
+    invariant = []
+    paths = resolve_factor_paths(schedule, r_date, invariant)
+    varying = [factor for factor in FACTORS if factor not in invariant]
+
+    # Partial product of the time-invariant factors (e.g. K*P*LS), which is kept for the whole run
+    partial_key = ('partial',) + tuple(paths[factor] if factor in invariant else None for factor in FACTORS)
+    if partial_key not in cache['pinned'] and len(invariant) > 0:
+        arrays = [get_factor_array(cache, paths[factor], pinned=True) for factor in invariant]
+        cache['pinned'][partial_key] = r_calc.calculate_static_factors(*arrays)
+    if len(varying) == 0:
+        return cache['pinned'][partial_key]
+
+    key = ('product',) + tuple(paths[factor] for factor in FACTORS)
+    if key in cache['items']:
+        cache['items'].move_to_end(key)
+        return cache['items'][key]
+
+    arrays = [get_factor_array(cache, paths[factor]) for factor in varying]
+    if len(invariant) > 0:
+        arrays = [cache['pinned'][partial_key]] + arrays
+    product = r_calc.calculate_static_factors(*arrays)
+    add_to_cache(cache, key, product)
+    return product
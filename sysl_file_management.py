@@ -75,14 +75,14 @@ def check_folder(path, additional_folders=True):
     :param additional_folders: boolean, if True create subfolders for SL, SY, Total SY results, if False, only check
     input folder
     """
+    # exist_ok: the folders can be created at the same time by several processes (sharded or batch execution)
     if not os.path.exists(path):
         print("Creating folder: ", path)
-        os.makedirs(path)
-        if additional_folders:
-            print("Creating additional folders for SL, SY, SY_Total")
-            os.makedirs(os.path.join(path, "SL"))
-            os.makedirs(os.path.join(path, "SY"))
-            os.makedirs(os.path.join(path, "SY_Total"))
+    os.makedirs(path, exist_ok=True)
+    if additional_folders:
+        os.makedirs(os.path.join(path, "SL"), exist_ok=True)
+        os.makedirs(os.path.join(path, "SY"), exist_ok=True)
+        os.makedirs(os.path.join(path, "SY_Total"), exist_ok=True)
 
 
 def filter_raster_lists(raster_list, date1, date2, file_name):
@@ -160,3 +160,54 @@ def save_summary_table(TDA, k, dates, save_path):
     # Save the final Data frame to a .txt file:
     results.to_csv(save_path, index=False, sep='\t', na_rep="")
     print("Summary table saved: ", save_path)
+
+
+def save_ensemble_table(data, k, dates, quantiles, save_path):
+    """
+    Function saves the quantiles of the ensemble results for one watershed into a .txt file. The columns contain the
+    quantiles of the mean SL, mean SY, total SY and bed load (optional) of all ensemble members for each month.
+
+    :param data: 4D np.array where the ensemble results are saved (watershed, month, variable, quantile)
+    :param k: int, the watershed to save
+    :param dates: np.array, with the date for each analyzed month (in string YYYYMM format)
+    :param quantiles: list, with the quantiles (in %) that were calculated
+    :param save_path: string, file path (including name.txt) with which to save resulting table
+    """
+    variables = ["Mean Soil Loss {} [ton/ha*month]", "Mean Sediment Yield {} [ton/month]",
+                 'Total Sediment Yield {} [ton/month]', 'Bed Load {} [ton/month]']
+    columns = [variables[v].format(f'Q{q:g}') for v in range(0, data.shape[2]) for q in quantiles]
+
+    # Generate data frame with the values of each variable and quantile, and join it with the dates
+    df = pd.DataFrame(data=np.reshape(data[k], (data.shape[1], -1)), index=None, columns=columns)
+    df_dates = pd.DataFrame(data=dates, index=None, columns=['Date'])
+    results = pd.concat([df_dates, df], axis=1)
+
+    results.to_csv(save_path, index=False, sep='\t', na_rep="")
+    print("Ensemble table saved: ", save_path)
+
+
+def save_scenario_table(data, k, dates, names, save_path):
+    """
+    Function saves the results of all scenarios for one watershed into a .txt file. The table has one row for each
+    scenario and month, with the mean SL, mean SY, total SY and bed load (optional).
+
+    :param data: 4D np.array where the scenario results are saved (watershed, scenario, month, result column)
+    :param k: int, the watershed to save
+    :param dates: np.array, with the date for each analyzed month (in string YYYYMM format)
+    :param names: list, with the scenario names in the order of data
+    :param save_path: string, file path (including name.txt) with which to save resulting table
+    """
+    columns = ["Mean Soil Loss [ton/ha*month]", "Mean Sediment Yield [ton/month]",
+               'Total Sediment Yield [ton/month]', 'Bed Load [ton/month]'][0:data.shape[3]]
+
+    # Generate one data frame for each scenario and join them, so the months of each scenario follow each other
+    frames = []
+    for s in range(0, len(names)):
+        df = pd.DataFrame(data=data[k, s], index=None, columns=columns)
+        df.insert(0, 'Scenario', names[s])
+        df.insert(0, 'Date', np.ravel(dates))
+        frames.append(df)
+    results = pd.concat(frames, axis=0)
+
+    results.to_csv(save_path, index=False, sep='\t', na_rep="")
+    print("Scenario table saved: ", save_path)
@@ -56,22 +56,31 @@ def calculate_sdr(tt, beta, path, gt, proj, save):
     return sdr
 
 
-def calculate_sl(r, c, k, p, ls):
+def calculate_static_factors(*factors):
+    """
+    Function calculates the product of the factors of the RUSLE model which do not depend on the R factor (C, K, P and
+    LS), or of a part of them (e.g. the partial product K*P*LS of the time-invariant factors and the C factor).
+
+    :param factors: np.arrays, with the factor values (or partial products of factors) to multiply
+
+    :return: np.array with the product of the factors (e.g. C*K*P*LS)
+    """
+    product = factors[0]
+    for factor in factors[1:]:
+        product = product * factor
+    return product
+
+
+def calculate_sl(r, static):
     """
     Function calculates soil loss (ton/ha*month) based on the RUSLE model by Renard et al (1997)
 
     :param r: np.array, with monthly R(ain) factor values
-    :param c: np.array, with land C(over) factor values
-    :param k: np.array, with soil erodibility factor
-    :param p: np.array, with support P(ractice) factor
-    :param ls: np.array, with L(ength) and S(lope) factor
+    :param static: np.array, with the product of the C, K, P and LS factors (see function 'calculate_static_factors')
 
     :return: np.array with sediment loss values
-
-    Note: If more values are to be added to the equation in the future, they must be added as an additional argument to
-        the function.
     """
-    sl = r * c * k * p * ls
+    sl = r * static
 
     # Convert masked pixels to np.nan values
     sl = sl.filled(np.nan)  # Convert pixels which multiplied a masked pixel with a value pixel (value = "--") to np.nan
@@ -112,13 +121,15 @@ def calculate_total_sy(sy):
     return sy_tot
 
 
-def calculate_bl(sy, dates):
+def calculate_bl(sy, dates, axis=None):
     """
     Function calculates the bed load (BL) after Turowski et al (2010) based on the suspended load rate
 
     Args:
     :param sy: np.array with sediment yield values
     :param dates: string with date in format YYYYMM
+    :param axis: int, axis of 'sy' over which to average the sediment yield. If None, the bed load is calculated for
+    the mean of all values, otherwise one bed load value is calculated for each element along the remaining axes.
 
     :return: np.array with bed load values
     """
@@ -128,18 +139,36 @@ def calculate_bl(sy, dates):
     days_per_month = monthrange(year, month)[1]
     sec_month = days_per_month * 24 * 60 * 60
 
-    sl = np.nanmean(sy)
+    sl = np.nanmean(sy, axis=axis)
     sl_rate = sl / sec_month * 1000
 
-    if sl_rate <= 0.394206310:
-        bl_rate = 0.833 * sl_rate ** 1.34
-    else:
-        bl_rate = 0.437 * sl_rate ** 0.647
+    bl_rate = np.where(sl_rate <= 0.394206310, 0.833 * sl_rate ** 1.34, 0.437 * sl_rate ** 0.647)
     bl = bl_rate / 1000 * sec_month
 
     return bl
 
 
+def calculate_mask_sums(values, masks):
+    """
+    Function calculates the sum and the number of valid (not np.nan) pixels of each row of an array inside each mask.
+
+    Args:
+    :param values: 2D np.array, with one row of pixel values for each result (e.g. ensemble member or scenario)
+    :param masks: 2D boolean np.array, with one row for each mask (e.g. watershed), with the same pixels as 'values'
+
+    :return: 2 np.arrays, with the sum and with the number of valid pixels for each row (rows) in each mask (columns)
+
+    Note: the sums are calculated in float64, also for float32 values, so they match the sums of the single results
+    (e.g. the summary tables of sysl_main).
+    """
+    valid = ~np.isnan(values)
+    masks = masks.T.astype(np.float64)
+    sums = np.where(valid, values, 0).astype(np.float64) @ masks
+    counts = valid.astype(np.float64) @ masks
+
+    return sums, counts
+
+
 # Function calculates the mean for the clipped SL raster
 
 def clipped_sl_mean(sl_path, data, i, k):
@@ -30,100 +30,135 @@ Notes:
 * Module calculates bed load based on the total SY (if corresponding user input calc_bed_load is True) and adds result
     to the resulting summary table.
 """
+import sysl_factor_schedule as fs
 import sysl_file_management as fm
 import sysl_functions as r_calc
 import sysl_raster_calculations as rc
+import sysl_statistics as st
 # Import files
 from config import *
 
-start_time = time.time()
-
-# Set the date ranges to analyze for:
-start_date = fm.get_date(start_date)
-end_date = fm.get_date(end_date)
-
-fm.check_folder(results_path, additional_folders=False)
-
-# Get all R raster .tif file paths into a list. The list is then filtered to only include the dates within the input
-# data range.
-R_filenames = sorted(glob.glob(r_folder + "/*.tif"))
-R_filenames = fm.filter_raster_lists(R_filenames, start_date, end_date, "Rfactor")
-
-# Get all shapes into a list
-clip_filenames = glob.glob(clip_path + "/*.shp")
-# print(Clip_filenames)
-
-# Check input raster properties and get raster properties:
-# If more input files are used, they must be added AT THE END of the list.
-if seasonal_cfactor:
-    raster_list = [R_filenames[0], k_path, ls_path, p_path, tt_path, c_winter_path, c_summer_path]
-else:
-    raster_list = [R_filenames[0], cp_path, k_path, ls_path, p_path, tt_path]
-gt, proj = rc.check_input_rasters(raster_list, pixel_area)
-
-# Save each constant into an array: if more input rasters are used, add them here with a corresponding array name
-# factor_array
-k_array = rc.raster_to_array(k_path)  # Array with K factor values
-p_array = rc.raster_to_array(p_path)  # Array with P factor values
-ls_array = rc.raster_to_array(ls_path)  # Array with LS factor values
-tt_array = rc.raster_to_array(tt_path)  # Array with transport time values
-if seasonal_cfactor:
-    c_summer_array = rc.raster_to_array(c_summer_path)
-    c_winter_array = rc.raster_to_array(c_winter_path)
-else:
-    cp_array = rc.raster_to_array(cp_path)  # Array with C factor values
-
-# Get SDR raster, which is independent of R factor and thus constant. The function also saves the SDR, if last input
-# value is set to "True"
-SDR_array = r_calc.calculate_sdr(tt_array, beta, results_path, gt, proj, True)
-
-# Create 3D array to save the results to a .txt file and a vector to save the dates
-# Num. Arrays: 1 for each shape file + total, Num. rows: months to analyze, columns: 3 or 4, depending on results to
-# calculate for
-if calc_bed_load:
-    result_cols = 4
-else:
-    result_cols = 3
-data_summary = np.full((len(clip_filenames) + 1, len(R_filenames), result_cols), 0.0)
-dates_vector = np.full((len(R_filenames), 1), "", dtype=object)
-# print("3D shape: ", data_summary.shape)
-# print("Dates shape: ", dates_vector.shape)
-
-# Loop through R factor rasters
-i = 0  # loop for every row in the 3D array (for every measurement month)
-for file in R_filenames:
-    r_name = os.path.basename(file)  # Get complete name of raster being analyzed (including extension)
-
-    # Get date and month to distinguish between summer and winter:
+
+def get_input_files(r_folder, clip_path, start_date, end_date):
+    """
+    Function gets the R factor rasters within the analysis date range and the clipping shapes.
+
+    :param r_folder: string, folder path with the monthly R factor .tif files
+    :param clip_path: string, folder path with the Catchment_NAME.shp files
+    :param start_date: datetime variable, analysis start date
+    :param end_date: datetime variable, analysis end date
+
+    :return: 2 lists, one with the filtered R factor raster paths and one with the shape file paths
+    """
+    # Get all R raster .tif file paths into a list. The list is then filtered to only include the dates within the input
+    # data range.
+    r_filenames = sorted(glob.glob(r_folder + "/*.tif"))
+    r_filenames = fm.filter_raster_lists(r_filenames, start_date, end_date, "Rfactor")
+
+    # Get all shapes into a list
+    clip_filenames = sorted(glob.glob(clip_path + "/*.shp"))
+
+    return r_filenames, clip_filenames
+
+
+def create_result_folders(clip_filenames):
+    """
+    Function creates the results folder of the total catchment and of each clipping shape, with their SL, SY and
+    SY_Total sub-folders. Modes in which several processes save results (sharded or batch execution) create them before
+    the processes start.
+
+    :param clip_filenames: list, with the shape file paths (Catchment_NAME.shp)
+    """
+    fm.check_folder(os.path.join(results_path, "Total"))
+    for shape in clip_filenames:
+        shape_name = os.path.splitext(os.path.basename(shape))[0][10:]  # File name must be is Catchment_NAME.
+        fm.check_folder(os.path.join(results_path, shape_name))
+
+
+def read_factors(r_path, save_sdr=True, schedule=None, interactive=True):
+    """
+    Function checks the input rasters, creates the factor schedule and cache for the time-varying factor rasters (C, K,
+    P, LS), reads the travel time raster and calculates the SDR array, which is independent of the R factor and thus
+    constant.
+
+    :param r_path: string, path of an R factor raster with which to compare the input rasters
+    :param save_sdr: boolean, when True saves the SDR raster to the results folder
+    :param schedule: dictionary, factor schedule (see sysl_factor_schedule). If None, the factor schedule is created
+    from the factor_schedule and input rasters in config.py
+    :param interactive: boolean, if False the user is not asked whether to continue if the projections of the input
+    rasters are different (see function 'check_input_rasters'), e.g. in worker processes without input
+
+    :return: dictionary with the 'TT' and 'SDR' arrays, the factor 'schedule' and the factor 'cache', GEOTransform
+    tuple and projection tuple
+    """
+    if schedule is None:
+        schedule = fs.get_factor_schedule(factor_schedule)
+
+    # Check input raster properties and get raster properties:
+    # If more input files are used, they must be added AT THE END of the list.
+    raster_list = [r_path, tt_path] + fs.get_schedule_paths(schedule)
+    gt, proj = rc.check_input_rasters(raster_list, pixel_area, interactive)
+
+    factors = {
+        'TT': rc.raster_to_array(tt_path),  # Array with transport time values
+        'schedule': schedule,
+        'cache': fs.create_factor_cache(factor_cache_mb),
+    }
+
+    # Get SDR raster. The function also saves the SDR, if last input value is set to "True"
+    factors['SDR'] = r_calc.calculate_sdr(factors['TT'], beta, results_path, gt, proj, save_sdr)
+
+    return factors, gt, proj
+
+
+def calculate_month(file, i, data_summary, factors, clip_filenames, gt, proj, total_path, R_array=None,
+                    accumulators=None, catchment_windows=None):
+    """
+    Function calculates the SL, SY and total SY rasters for one R factor raster, saves them for the total catchment and
+    clips them to each sub-catchment, and fills row "i" of the 3D summary array.
+
+    :param file: string, path of the R factor raster to analyze
+    :param i: int, row in the 3D array to fill (analyzed month)
+    :param data_summary: 3D np.array, with one array for the total catchment and one for each clipping shape
+    :param factors: dictionary with the constant arrays and the factor schedule, from function 'read_factors'
+    :param clip_filenames: list, with the shape file paths which correspond to arrays 1 to n in data_summary
+    :param gt: tuple with GEOTransform data with which to save the total catchment rasters
+    :param proj: tuple with projection data with which to save the total catchment rasters
+    :param total_path: string, folder path where to save the total catchment rasters
+    :param R_array: masked np.array with the R factor values, if it was already read (e.g. by 'prefetch_rasters'). If
+    None, the R factor raster is read.
+    :param accumulators: dictionary with the accumulators for the long-term statistics of the 'SL' and 'SY' pixels (see
+    sysl_statistics), which are updated with the month. If None, no statistics are calculated.
+    :param catchment_windows: list, with the window of each clipping shape (from function 'get_catchment_windows'). If
+    None, the total catchment rasters are clipped to each shape with gdalwarp, otherwise virtual rasters (.vrt) are
+    saved for each catchment (see function 'calculate_catchment_windows').
+
+    :return: string, with the date of the R factor raster (YYYYMM)
+    """
+    # Get date to get the factor rasters of the month:
     date = fm.get_date(file)
     r_date = str(date.strftime("%Y%m"))
     print(r_date)
-    r_month = r_date[4:6]
-    r_month = int(r_month)
 
     # Save the masked array for the R factor raster
-    R_array = rc.raster_to_array(file)  # Extract the data from the Rfactor file into a masked array
+    if R_array is None:
+        R_array = rc.raster_to_array(file)  # Extract the data from the Rfactor file into a masked array
 
     # Create folder to save the Total watershed files. Checks if it already exists, if not it creates it
-    total_path = os.path.join(results_path, "Total")
     fm.check_folder(total_path)
 
     # Calculate results for each R factor file (soil Loss(SL), sediment yield (SY), total SY)
-    if seasonal_cfactor:
-        if r_month == 1 or r_month == 2 or r_month == 3 or r_month == 10 or r_month == 11 or r_month == 12:
-            print('winter month')
-            sl_array = r_calc.calculate_sl(R_array, c_winter_array, k_array, p_array,
-                                           ls_array)  # Calculate SY for eac R Factor
-        else:
-            print('summer month')
-            sl_array = r_calc.calculate_sl(R_array, c_summer_array, k_array, p_array,
-                                           ls_array)  # Calculate SY for eac R Factor
-    else:
-        sl_array = r_calc.calculate_sl(R_array, cp_array, k_array, p_array, ls_array)
+    static_array = fs.get_static_factors(factors['schedule'], factors['cache'], r_date)
+    sl_array = r_calc.calculate_sl(R_array, static_array)
 
-    sy_array = r_calc.calculate_sy(sl_array, SDR_array, pixel_area)
+    sy_array = r_calc.calculate_sy(sl_array, factors['SDR'], pixel_area)
     sy_tot_array = r_calc.calculate_total_sy(sy_array)
 
+    # Update the long-term statistics of each pixel
+    if accumulators is not None:
+        st.update_accumulator(accumulators['SL'], sl_array)
+        st.update_accumulator(accumulators['SY'], sy_array)
+
     # Save the resulting rasters for the total watershed
     save_sl = os.path.join(total_path, 'SL', f'SL_Banja_{r_date}_Total.tif')
     rc.save_raster(sl_array, save_sl, gt, proj)  # Save array as raster
@@ -142,6 +177,12 @@ for file in R_filenames:
         bedL = r_calc.calculate_bl(sy_tot_array, r_date)
         data_summary[0][i][3] = bedL
 
+    # Virtual rasters: the results of each catchment are windows of the total catchment rasters
+    if catchment_windows is not None:
+        calculate_catchment_windows(sl_array, sy_array, save_sl, save_sy, r_date, i, data_summary, clip_filenames,
+                                    catchment_windows, gt, proj)
+        return r_date
+
     # Loop through Clipping Shapes (Masks)
     k = 1  # Loop for every array in the 3D array. Starts at 1, since array[0] is the total watershed.
     for shape in clip_filenames:
@@ -175,23 +216,230 @@ for file in R_filenames:
         rc.save_raster(sy_tot_array_clip, save_name, gt_clip, proj_clip)
 
         k += 1
-    dates_vector[i][0] = r_date  # Save the R Factor date in a different array, in row "i"
-    i += 1
-
-raster_time = time.time()
-print("Time to save rasters: ", time.time() - start_time)
-
-# Loops to save the .txt files with the results summary for each array (clipped shape) in the 3D array:
-for k in range(0, int(data_summary.shape[0])):
-    # Get the name of the array in order:
-    if k == 0:
-        file_name = os.path.join(total_path, "BanjaResults.txt")
-    else:  # for catchments, the file name must be is Catchment_NAME.
-        shape_name = os.path.splitext(os.path.basename(clip_filenames[k - 1])[10:])[0]
-        file_name = os.path.join(results_path, shape_name, f'{shape_name}.txt')
-    # Save array using function
-    fm.save_summary_table(data_summary, k, dates_vector, file_name)
-
-print("Time to save summary tables: ", time.time() - raster_time)
-print('Total time: ', time.time() - start_time)
-x = 1
+
+    return r_date
+
+
+def is_cached_raster(raster_path, source_path, gt, shape):
+    """
+    Function checks if a raster which was saved from a source file (e.g. the mask of a shape file) can be used again:
+    it must exist, be newer than the source file and be on the given grid, since the results folder can be used again
+    with other input rasters.
+
+    :param raster_path: string, path of the saved raster
+    :param source_path: string, path of the file from which the raster was saved
+    :param gt: tuple with the GEOTransform which the raster must have
+    :param shape: tuple with the number of rows and columns which the raster must have
+
+    :return: boolean, True if the saved raster can be used
+    """
+    if not os.path.exists(raster_path) or os.path.getmtime(raster_path) < os.path.getmtime(source_path):
+        return False
+    raster_data = rc.get_raster_data(raster_path)
+    if raster_data is None:  # Not a valid raster
+        return False
+    return tuple(rc.get_raster_size(raster_path)) == tuple(shape) and np.allclose(raster_data[0], gt)
+
+
+def get_catchment_masks(clip_filenames, gt, shape):
+    """
+    Function gets a boolean mask for the total catchment and each clipping shape on the grid of the input rasters. The
+    masks are saved to the 'Masks' folder in the results folder and are only rasterized again if the shape file is
+    newer than the saved mask or if the grid of the input rasters changed (see function 'is_cached_raster').
+
+    :param clip_filenames: list, with the shape file paths (Catchment_NAME.shp)
+    :param gt: tuple with the GEOTransform of the input rasters
+    :param shape: tuple with the number of rows and columns of the input rasters
+
+    :return: 3D boolean np.array, with one mask for the total catchment (all True) and one for each clipping shape
+    """
+    masks = np.full((len(clip_filenames) + 1, shape[0], shape[1]), True)
+    mask_folder = os.path.join(results_path, "Masks")
+    fm.check_folder(mask_folder, additional_folders=False)
+
+    k = 1  # Array 0 is the total watershed
+    for shape_file in clip_filenames:
+        shape_name = os.path.splitext(os.path.basename(shape_file))[0][10:]  # File name must be is Catchment_NAME.
+        mask_path = os.path.join(mask_folder, f'Mask_{shape_name}.tif')
+        if is_cached_raster(mask_path, shape_file, gt, shape):
+            masks[k] = rc.raster_to_array(mask_path).filled(0) == 1
+        else:
+            masks[k] = rc.rasterize_shape(shape_file, mask_path, gt, shape)
+        if not masks[k].any():
+            sys.exit('The shape ' + os.path.basename(shape_file) + " falls outside of the total raster." +
+                     " Check the input shape file and run program again. ")
+        k += 1
+    return masks
+
+
+def get_catchment_windows(clip_filenames, gt, proj, shape):
+    """
+    Function gets the window (bounding box in rows and columns) of each clipping shape in the total catchment rasters
+    and saves its cutline mask, which has a value of 1 inside the shape and np.nan outside, cropped to the window. The
+    cutline masks are saved to the 'Masks' folder in the results folder and are only saved again if the shape file is
+    newer than the saved mask or if the grid of the input rasters changed.
+
+    :param clip_filenames: list, with the shape file paths (Catchment_NAME.shp)
+    :param gt: tuple with the GEOTransform of the input rasters
+    :param proj: tuple with the projection of the input rasters
+    :param shape: tuple with the number of rows and columns of the input rasters
+
+    :return: list, with a dictionary for each clipping shape with the 'window' (first row, last row + 1, first column,
+    last column + 1), the boolean 'mask' of the window and the path of the 'cutline' mask raster
+    """
+    masks = get_catchment_masks(clip_filenames, gt, shape)
+    windows = []
+    k = 1  # Array 0 is the total watershed
+    for shape_file in clip_filenames:
+        shape_name = os.path.splitext(os.path.basename(shape_file))[0][10:]  # File name must be is Catchment_NAME.
+        rows = np.where(masks[k].any(axis=1))[0]
+        cols = np.where(masks[k].any(axis=0))[0]
+        window = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+        mask = masks[k][window[0]:window[1], window[2]:window[3]]
+
+        cutline = os.path.join(results_path, "Masks", f'Cutline_{shape_name}.tif')
+        gt_window = rc.get_window_geotransform(gt, window)
+        if not is_cached_raster(cutline, shape_file, gt_window, mask.shape):
+            rc.save_raster(np.where(mask, 1, np.nan).astype(np.float32), cutline, gt_window, proj)
+
+        windows.append({'window': window, 'mask': mask, 'cutline': cutline})
+        k += 1
+    return windows
+
+
+def calculate_catchment_windows(sl_array, sy_array, save_sl, save_sy, r_date, i, data_summary, clip_filenames,
+                                catchment_windows, gt, proj):
+    """
+    Function calculates the summary results of each catchment from the window of the total catchment arrays and saves
+    the SL, SY and total SY of each catchment as virtual rasters (.vrt), which read the window of the total catchment
+    rasters and multiply it with the cutline mask of the catchment. No pixels are copied.
+
+    :param sl_array: np.array with the SL values of the total catchment
+    :param sy_array: np.array with the SY values of the total catchment
+    :param save_sl: string, path of the SL raster of the total catchment
+    :param save_sy: string, path of the SY raster of the total catchment
+    :param r_date: string, with the date of the month (YYYYMM)
+    :param i: int, row in the 3D array to fill (analyzed month)
+    :param data_summary: 3D np.array, with one array for the total catchment and one for each clipping shape
+    :param clip_filenames: list, with the shape file paths which correspond to arrays 1 to n in data_summary
+    :param catchment_windows: list, with the window of each clipping shape (from function 'get_catchment_windows')
+    :param gt: tuple with GEOTransform data of the total catchment rasters
+    :param proj: tuple with projection data with which to save the virtual rasters
+    """
+    k = 1  # Loop for every array in the 3D array. Starts at 1, since array[0] is the total watershed.
+    for shape, catchment in zip(clip_filenames, catchment_windows):
+        shape_name = os.path.splitext(os.path.basename(shape))[0][10:]  # File name must be is Catchment_NAME.
+        save_path = os.path.join(results_path, shape_name)
+        fm.check_folder(save_path)
+
+        # Catchment arrays, with np.nan outside of the shape
+        r0, r1, c0, c1 = catchment['window']
+        sl_clip = np.where(catchment['mask'], sl_array[r0:r1, c0:c1], np.nan)
+        sy_clip = np.where(catchment['mask'], sy_array[r0:r1, c0:c1], np.nan)
+        sy_tot_array_clip = r_calc.calculate_total_sy(sy_clip)
+
+        data_summary[k][i][0] = np.nanmean(sl_clip)
+        data_summary[k][i][1] = np.nanmean(sy_clip)
+        data_summary[k][i][2] = np.nanmean(sy_tot_array_clip)
+        if calc_bed_load:
+            data_summary[k][i][3] = r_calc.calculate_bl(sy_tot_array_clip, r_date)
+
+        # Save the virtual rasters: the total SY is the SY window with a scale of 0 and an offset of the total SY
+        rc.save_window_vrt(os.path.join(save_path, 'SL', f'SL_{r_date}_{shape_name}.vrt'), save_sl,
+                           catchment['cutline'], catchment['window'], gt, proj)
+        rc.save_window_vrt(os.path.join(save_path, 'SY', f'SY_{r_date}_{shape_name}.vrt'), save_sy,
+                           catchment['cutline'], catchment['window'], gt, proj)
+        rc.save_window_vrt(os.path.join(save_path, 'SY_Total', f'SYTot_{r_date}_{shape_name}.vrt'), save_sy,
+                           catchment['cutline'], catchment['window'], gt, proj, offset=data_summary[k][i][2])
+        k += 1
+
+
+def create_summary_array(n_catchments, n_months):
+    """
+    Function creates the 3D array in which the summary results are saved.
+
+    :param n_catchments: int, number of clipping shapes (the total catchment is added to it)
+    :param n_months: int, number of months to analyze
+
+    :return: 3D np.array filled with 0.0. Num. arrays: 1 for each shape file + total, Num. rows: months to analyze,
+    columns: 3 or 4, depending on results to calculate for
+    """
+    if calc_bed_load:
+        result_cols = 4
+    else:
+        result_cols = 3
+    return np.full((n_catchments + 1, n_months, result_cols), 0.0)
+
+
+def save_summary_tables(data_summary, dates_vector, clip_filenames):
+    """
+    Function saves the .txt files with the results summary for each array (clipped shape) in the 3D array.
+
+    :param data_summary: 3D np.array, with one array for the total catchment and one for each clipping shape
+    :param dates_vector: np.array, with the date for each analyzed month (in string YYYYMM format)
+    :param clip_filenames: list, with the shape file paths which correspond to arrays 1 to n in data_summary
+    """
+    total_path = os.path.join(results_path, "Total")
+    for k in range(0, int(data_summary.shape[0])):
+        # Get the name of the array in order:
+        if k == 0:
+            file_name = os.path.join(total_path, "BanjaResults.txt")
+        else:  # for catchments, the file name must be is Catchment_NAME.
+            shape_name = os.path.splitext(os.path.basename(clip_filenames[k - 1])[10:])[0]
+            file_name = os.path.join(results_path, shape_name, f'{shape_name}.txt')
+        # Save array using function
+        fm.save_summary_table(data_summary, k, dates_vector, file_name)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    # Set the date ranges to analyze for:
+    start_date = fm.get_date(start_date)
+    end_date = fm.get_date(end_date)
+
+    fm.check_folder(results_path, additional_folders=False)
+
+    R_filenames, clip_filenames = get_input_files(r_folder, clip_path, start_date, end_date)
+
+    # Save each constant into an array and get the SDR raster, which is independent of R factor and thus constant.
+    factors, gt, proj = read_factors(R_filenames[0])
+
+    # Create 3D array to save the results to a .txt file and a vector to save the dates
+    data_summary = create_summary_array(len(clip_filenames), len(R_filenames))
+    dates_vector = np.full((len(R_filenames), 1), "", dtype=object)
+
+    # Get the windows and cutline masks of the catchments, if virtual rasters are saved instead of clipped rasters
+    if output_mode == 'vrt':
+        catchment_windows = get_catchment_windows(clip_filenames, gt, proj, factors['TT'].shape)
+    else:
+        catchment_windows = None
+
+    # Create the accumulators for the long-term statistics of each pixel
+    if temporal_statistics:
+        accumulators = {name: st.create_accumulator(factors['TT'].shape, statistics_thresholds.get(name, []),
+                                                    statistics_quantiles) for name in ['SL', 'SY']}
+    else:
+        accumulators = None
+
+    # Loop through R factor rasters
+    total_path = os.path.join(results_path, "Total")
+    i = 0  # loop for every row in the 3D array (for every measurement month)
+    # The next R factor rasters are read on a background thread while the current month is calculated
+    for file, R_array in rc.prefetch_rasters(R_filenames, prefetch_depth):
+        r_date = calculate_month(file, i, data_summary, factors, clip_filenames, gt, proj, total_path, R_array,
+                                 accumulators, catchment_windows)
+        dates_vector[i][0] = r_date  # Save the R Factor date in a different array, in row "i"
+        i += 1
+
+    raster_time = time.time()
+    print("Time to save rasters: ", time.time() - start_time)
+    print("Factor rasters read: ", factors['cache']['reads'])
+
+    if accumulators is not None:
+        st.save_statistics(accumulators, os.path.join(results_path, "Statistics"), gt, proj)
+
+    save_summary_tables(data_summary, dates_vector, clip_filenames)
+
+    print("Time to save summary tables: ", time.time() - raster_time)
+    print('Total time: ', time.time() - start_time)
@@ -0,0 +1,303 @@
+"""
+Module answers zonal queries (total and mean SL or SY per month in a bounding box or polygon) from the monthly results
+of the total catchment, without running the model again.
+
+Usage:
+    python sysl_query.py build   -> saves the monthly stacks and summed-area tables of the results in results_path
+    python sysl_query.py serve   -> answers queries over HTTP on localhost (port query_port)
+
+    HTTP queries (the answer is a JSON with the 'dates' and the 'total', 'mean' and 'count' (valid pixels) per month):
+        GET  http://localhost:PORT/query?variable=SY&bbox=x_min,y_min,x_max,y_max
+        POST http://localhost:PORT/query with a JSON body {"variable": "SY", "geometry": GeoJSON Polygon/MultiPolygon}
+        GET  http://localhost:PORT/info -> dates, variables and grid of the stacks
+
+    Python API:
+        stacks = open_stacks(results_path)
+        result = query(stacks, 'SY', bbox=(x_min, y_min, x_max, y_max)) or query(stacks, 'SY', geometry=geojson)
+
+Notes:
+* The stacks are saved to the 'Query' folder in the results folder as memory-mapped .npy files, with one array per
+    month: the values (float32), the summed-area table of the values (float64) and the summed-area table of the number
+    of valid pixels (int64). The summed-area tables take 4 times the memory of the values on disk.
+* Bounding box queries only read 4 values of each summed-area table per month. Polygon queries read the window of the
+    polygon from the value stack.
+* Coordinates must be in the projection of the results. A pixel is inside a bounding box or polygon if its center is
+    inside. The grid is the grid of the total catchment rasters (function 'get_raster_data').
+* Rasterized polygons are kept in a least recently used cache (see sysl_factor_schedule), whose size is query_cache_mb.
+"""
+import sysl_factor_schedule as fs
+import sysl_file_management as fm
+import sysl_raster_calculations as rc
+from config import *
+
+
+def get_result_rasters(results_path, variable):
+    """
+    Function gets the monthly rasters of a variable of the total catchment, sorted by date.
+
+    :param results_path: string, path of the results folder
+    :param variable: string, 'SL' or 'SY'
+
+    :return: list, with the raster paths
+    """
+    rasters = glob.glob(os.path.join(results_path, "Total", variable, "*.tif"))
+    if len(rasters) == 0:
+        sys.exit("ERROR: There are no " + variable + " rasters in " + os.path.join(results_path, "Total", variable))
+    return sorted(rasters, key=fm.get_date)
+
+
+def build_stacks(results_path, variables):
+    """
+    Function saves the monthly rasters of each variable to a stack and calculates the summed-area tables of the values
+    and of the number of valid pixels of each month.
+
+    :param results_path: string, path of the results folder
+    :param variables: list, with the variables to stack ('SL', 'SY')
+
+    :return: dictionary with the index of the stacks (see function 'open_stacks')
+    """
+    query_path = os.path.join(results_path, "Query")
+    fm.check_folder(query_path, additional_folders=False)
+
+    index = {'variables': list(variables)}
+    for variable in variables:
+        rasters = get_result_rasters(results_path, variable)
+        dates = [fm.get_date(raster).strftime('%Y%m') for raster in rasters]
+        if 'dates' not in index:
+            gt, proj = rc.get_raster_data(rasters[0])
+            index.update({'dates': dates, 'gt': list(gt), 'proj': proj})
+        elif dates != index['dates']:
+            sys.exit("ERROR: The " + variable + " rasters do not have the same months as the " + variables[0] +
+                     " rasters.")
+
+        first = rc.raster_to_array(rasters[0])
+        n_rows, n_cols = first.shape
+        index['shape'] = [n_rows, n_cols]
+        values = np.lib.format.open_memmap(os.path.join(query_path, f'{variable}_values.npy'), mode='w+',
+                                           dtype=np.float32, shape=(len(rasters), n_rows, n_cols))
+        sums = np.lib.format.open_memmap(os.path.join(query_path, f'{variable}_sat.npy'), mode='w+',
+                                         dtype=np.float64, shape=(len(rasters), n_rows + 1, n_cols + 1))
+        counts = np.lib.format.open_memmap(os.path.join(query_path, f'{variable}_count.npy'), mode='w+',
+                                           dtype=np.int64, shape=(len(rasters), n_rows + 1, n_cols + 1))
+
+        # Read the next rasters while the summed-area tables of the current month are calculated
+        i = 0
+        for raster, array in rc.prefetch_rasters(rasters, prefetch_depth):
+            array = array.filled(np.nan)
+            valid = ~np.isnan(array)
+            values[i] = array
+            sums[i, 0, :] = 0
+            sums[i, :, 0] = 0
+            sums[i, 1:, 1:] = np.cumsum(np.cumsum(np.where(valid, array, 0), axis=0, dtype=np.float64), axis=1)
+            counts[i, 0, :] = 0
+            counts[i, :, 0] = 0
+            counts[i, 1:, 1:] = np.cumsum(np.cumsum(valid, axis=0, dtype=np.int64), axis=1)
+            i += 1
+        values.flush()
+        sums.flush()
+        counts.flush()
+        print("Stack saved: ", variable, len(rasters), "months")
+
+    with open(os.path.join(query_path, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def open_stacks(results_path, cache_mb=256):
+    """
+    Function opens the stacks of the results folder as read-only memory-mapped arrays.
+
+    :param results_path: string, path of the results folder
+    :param cache_mb: float, maximum memory (in MB) of the cache of rasterized polygons
+
+    :return: dictionary with the 'dates', 'variables', 'gt', 'proj' and 'shape' of the stacks, the memory-mapped
+    'values', 'sat' and 'count' arrays of each variable, the polygon 'cache' and its 'lock'
+    """
+    query_path = os.path.join(results_path, "Query")
+    index_file = os.path.join(query_path, 'index.json')
+    if not os.path.exists(index_file):
+        sys.exit("ERROR: There are no stacks in " + query_path + ". Run 'python sysl_query.py build' first.")
+    with open(index_file) as f:
+        stacks = json.load(f)
+
+    for name in ['values', 'sat', 'count']:
+        stacks[name] = {variable: np.load(os.path.join(query_path, f'{variable}_{name}.npy'), mmap_mode='r')
+                        for variable in stacks['variables']}
+    stacks['cache'] = fs.create_factor_cache(cache_mb)
+    stacks['lock'] = threading.Lock()  # The HTTP server answers queries on several threads
+    return stacks
+
+
+def get_bbox_window(bbox, gt, shape):
+    """
+    Function gets the window of the pixels whose center is inside a bounding box, clipped to the grid.
+
+    :param bbox: tuple with x_min, y_min, x_max, y_max
+    :param gt: tuple with the GEOTransform of the grid
+    :param shape: tuple with the number of rows and columns of the grid
+
+    :return: tuple with the first row, last row + 1, first column and last column + 1 of the window
+    """
+    x_min, y_min, x_max, y_max = [float(v) for v in bbox]
+    c0 = min(max(int(np.ceil((x_min - gt[0]) / gt[1] - 0.5)), 0), shape[1])
+    c1 = min(max(int(np.floor((x_max - gt[0]) / gt[1] - 0.5)) + 1, c0), shape[1])
+    r0 = min(max(int(np.ceil((y_max - gt[3]) / gt[5] - 0.5)), 0), shape[0])
+    r1 = min(max(int(np.floor((y_min - gt[3]) / gt[5] - 0.5)) + 1, r0), shape[0])
+    return r0, r1, c0, c1
+
+
+def get_geometry_mask(stacks, geometry):
+    """
+    Function gets the rasterized mask of a GeoJSON geometry from the polygon cache, or rasterizes it if it is not in
+    the cache.
+
+    :param stacks: dictionary, from function 'open_stacks'
+    :param geometry: dictionary, GeoJSON Polygon or MultiPolygon geometry (or a Feature with such a geometry)
+
+    :return: tuple with the window and the boolean mask of the window (see function 'rasterize_polygons')
+    """
+    if isinstance(geometry, dict) and geometry.get('type') == 'Feature':
+        geometry = geometry.get('geometry')
+    if not isinstance(geometry, dict) or geometry.get('type') not in ['Polygon', 'MultiPolygon']:
+        raise ValueError("The geometry must be a GeoJSON Polygon or MultiPolygon.")
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    else:
+        polygons = geometry['coordinates']
+
+    key = ('polygon', json.dumps(polygons))
+    with stacks['lock']:
+        if key in stacks['cache']['items']:
+            stacks['cache']['items'].move_to_end(key)
+            return stacks['cache']['items'][key]
+    window, mask = rc.rasterize_polygons(polygons, stacks['gt'], stacks['shape'])
+    if mask is None:
+        mask = np.zeros((0, 0), dtype=bool)
+    with stacks['lock']:
+        fs.add_to_cache(stacks['cache'], key, (window, mask))
+    return window, mask
+
+
+def query(stacks, variable, bbox=None, geometry=None):
+    """
+    Function gets the total and mean of a variable in a bounding box or polygon for each month.
+
+    :param stacks: dictionary, from function 'open_stacks'
+    :param variable: string, 'SL' or 'SY'
+    :param bbox: tuple with x_min, y_min, x_max, y_max (if geometry is None)
+    :param geometry: dictionary, GeoJSON Polygon or MultiPolygon geometry (if bbox is None)
+
+    :return: dictionary with the 'dates' and the 'total', 'mean' and 'count' (number of valid pixels) for each month
+    """
+    if variable not in stacks['variables']:
+        raise ValueError("The variable " + str(variable) + " is not in the stacks " + str(stacks['variables']) + ".")
+
+    if bbox is not None:
+        # Summed-area tables: sum of the window from the 4 corners of each month
+        r0, r1, c0, c1 = get_bbox_window(bbox, stacks['gt'], stacks['shape'])
+        sat = stacks['sat'][variable]
+        count = stacks['count'][variable]
+        totals = sat[:, r1, c1] - sat[:, r0, c1] - sat[:, r1, c0] + sat[:, r0, c0]
+        counts = count[:, r1, c1] - count[:, r0, c1] - count[:, r1, c0] + count[:, r0, c0]
+    elif geometry is not None:
+        window, mask = get_geometry_mask(stacks, geometry)
+        if window is None or not mask.any():
+            totals = np.zeros(len(stacks['dates']))
+            counts = np.zeros(len(stacks['dates']), dtype=int)
+        else:
+            r0, r1, c0, c1 = window
+            values = np.asarray(stacks['values'][variable][:, r0:r1, c0:c1])[:, mask]
+            totals = np.nansum(values, axis=1, dtype=np.float64)
+            counts = (~np.isnan(values)).sum(axis=1)
+    else:
+        raise ValueError("A bounding box or a geometry is needed.")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, totals / np.maximum(counts, 1), np.nan)
+    return {'variable': variable,
+            'dates': stacks['dates'],
+            'total': [None if np.isnan(v) else float(v) for v in np.where(counts > 0, totals, np.nan)],
+            'mean': [None if np.isnan(v) else float(v) for v in means],
+            'count': [int(v) for v in counts]}
+
+
+def create_handler(stacks):
+    """
+    Function creates the HTTP request handler which answers the queries with the stacks.
+
+    :param stacks: dictionary, from function 'open_stacks'
+
+    :return: BaseHTTPRequestHandler class
+    """
+
+    class QueryHandler(http.server.BaseHTTPRequestHandler):
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def answer(self, request):
+            try:
+                bbox = request.get('bbox')
+                if isinstance(bbox, str):
+                    bbox = bbox.split(',')
+                self.send_json(200, query(stacks, request.get('variable', 'SY'), bbox=bbox,
+                                          geometry=request.get('geometry')))
+            except (ValueError, KeyError, TypeError, IndexError) as error:
+                self.send_json(400, {'error': str(error)})
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path == '/info':
+                self.send_json(200, {name: stacks[name] for name in ['dates', 'variables', 'gt', 'proj', 'shape']})
+            elif url.path == '/query':
+                self.answer({key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()})
+            else:
+                self.send_json(404, {'error': 'Use /query or /info.'})
+
+        def do_POST(self):
+            if urllib.parse.urlparse(self.path).path != '/query':
+                self.send_json(404, {'error': 'Use /query.'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                self.send_json(400, {'error': 'The request body must be a JSON object.'})
+                return
+            self.answer(request)
+
+    return QueryHandler
+
+
+def serve(stacks, port):
+    """
+    Function answers queries over HTTP on localhost until the program is stopped.
+
+    :param stacks: dictionary, from function 'open_stacks'
+    :param port: int, port on localhost
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), create_handler(stacks))
+    print("Query service on http://127.0.0.1:" + str(port) + " (stop with Ctrl+C)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'build':
+        start_time = time.time()
+        build_stacks(results_path, query_variables)
+        print('Total time: ', time.time() - start_time)
+    elif command == 'serve':
+        serve(open_stacks(results_path, query_cache_mb), query_port)
+    else:
+        sys.exit("Usage: python sysl_query.py build | serve")
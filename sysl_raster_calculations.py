@@ -4,10 +4,12 @@ input.
 """
 from config import *
 
+PIXEL_BYTES = np.dtype(np.float32).itemsize + 1  # Memory of each pixel of the masked arrays of 'raster_to_array'
+
 
 # Functions to check input raster files:
 
-def check_input_rasters(list_rasters, input_area):
+def check_input_rasters(list_rasters, input_area, interactive=True):
     """
     Function checks if all input raster files have the same configuration, including pixel resolution, raster extension
     and projection. All rasters are compared to the RFactor_REM_db raster, since it comes from the RFactor_REM_db python
@@ -16,6 +18,8 @@ def check_input_rasters(list_rasters, input_area):
 
     :param list_rasters: list, with all raster data paths to check and compare
     :param input_area: float, with the area of each pixel (in ha), which was set by the user.
+    :param interactive: boolean, if False the user is not asked whether to continue if the projections are different,
+    e.g. in worker processes without input, whose rasters were already checked by the process which started them.
 
     :return: 2 tuples, one for the GEOTransform and one for the projection for the RFactor_REM_db raster file.
 
@@ -24,7 +28,7 @@ def check_input_rasters(list_rasters, input_area):
     program.
     * If two files have the same extension and pixel resolution but different projection, a WARNING is sent and the user
     can choose, by introducing a "1" in the comment line to continue the calculations or to end the program to change
-    input rasters by introducing a "0".
+    input rasters by introducing a "0". If interactive is False, only the WARNING is sent and the calculations continue.
     * The function assumes the raster projection and GEOTransform data is in meters.
     """
     # Loop through each raster file in the input raster file list
@@ -50,14 +54,15 @@ def check_input_rasters(list_rasters, input_area):
             if proj_r != proj_new:
                 print("The raster " + str(os.path.basename(file)),
                       " does not have the same projection as the other input rasters.")
-                message = "Press 1 if you want to continue with the program or 0 if you want" + \
-                          " to check the input rasters and stop the program. \n"
-                decision = input(message)
-                while decision != "0" and decision != "1":  # If the user inputs an invalid option.
-                    print("Invalid input '", decision, "'.")
-                    decision = input(message)  # Resend message
-                if decision == "0":  # If user wants to stop the program.
-                    sys.exit("Exit program. Check input raster projections.")
+                if interactive:
+                    message = "Press 1 if you want to continue with the program or 0 if you want" + \
+                              " to check the input rasters and stop the program. \n"
+                    decision = input(message)
+                    while decision != "0" and decision != "1":  # If the user inputs an invalid option.
+                        print("Invalid input '", decision, "'.")
+                        decision = input(message)  # Resend message
+                    if decision == "0":  # If user wants to stop the program.
+                        sys.exit("Exit program. Check input raster projections.")
         i += 1
 
     # Check pixel resolution and pixel area (assuming input rasters are in meters)
@@ -120,6 +125,22 @@ def get_raster_data(raster_path):
         return gt, proj
 
 
+def get_raster_size(raster_path):
+    """
+        Function gets the number of rows and columns of a raster file, without reading the raster data
+
+        :param raster_path: raster file path, including name.tif
+
+        :return: tuple with the number of rows and columns of the raster
+        """
+    try:
+        raster = gdal.Open(raster_path)  # Only the raster header is read
+        shape = (raster.RasterYSize, raster.RasterXSize)
+    except AttributeError:
+        sys.exit("The input file " + raster_path + " is not a valid raster file or does not exist.")
+    return shape
+
+
 def create_masked_array(array, no_data):
     """
         Function masks the no_data values in an input array, which contains the data values from a raster file
@@ -155,6 +176,57 @@ def raster_to_array(raster_path):
     return masked_array
 
 
+def prefetch_rasters(raster_paths, depth):
+    """
+    Generator function which reads the rasters of a list in order and yields their masked arrays. The rasters are read
+    and decoded on a background thread while the previous arrays are used, so reading and calculations overlap.
+
+    :param raster_paths: list, with the paths of the .tif raster files to read
+    :param depth: int, maximum number of arrays which are read ahead of the array being used. If 0, each raster is
+    only read when it is needed.
+
+    :return: yields a tuple with the raster path and its masked np.array (see function 'raster_to_array')
+
+    Note: at most 'depth' arrays wait to be used, plus the one being read by the background thread. If a raster can not
+    be read, the error is raised when its array would be yielded. If the generator is closed before all rasters are
+    read, the background thread stops after the raster it is reading.
+    """
+    if depth <= 0:
+        for path in raster_paths:
+            yield path, raster_to_array(path)
+        return
+
+    buffers = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def read_rasters():
+        for raster_path in raster_paths:
+            try:
+                item = (raster_path, raster_to_array(raster_path), None)
+            except BaseException as error:  # Also passes sys.exit() errors to the main thread
+                item = (raster_path, None, error)
+            while not stop.is_set():
+                try:
+                    buffers.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set() or item[2] is not None:
+                return
+
+    reader = threading.Thread(target=read_rasters, name="raster_prefetch", daemon=True)
+    reader.start()
+    try:
+        for _ in raster_paths:
+            path, array, error = buffers.get()
+            if error is not None:
+                raise error
+            yield path, array
+    finally:
+        stop.set()
+        reader.join()
+
+
 def clip_raster(original_raster, clipped_path, shape_path):
     """
     Function clips the raster to the same extents as an input shapefile and saves the clipped raster using gdalwarp.
@@ -179,6 +251,152 @@ def clip_raster(original_raster, clipped_path, shape_path):
     os.system("gdalinfo -stats " + clipped_path)
 
 
+def rasterize_shape(shape_path, mask_path, gt, shape):
+    """
+    Function rasterizes a shape file to the grid of the input rasters using gdal_rasterize, and saves the mask raster.
+    Pixels whose center is inside the shape have a value of 1 and all other pixels a value of 0.
+
+    :param shape_path: file path (including extension and name) of the shape file to rasterize
+    :param mask_path: file path (including extension and name) where to save the mask raster
+    :param gt: tuple with the GEOTransform of the grid on which to rasterize the shape
+    :param shape: tuple with the number of rows and columns of the grid
+
+    :return: boolean np.array, which is True for all pixels inside the shape
+    """
+    x_min = gt[0]
+    y_max = gt[3]
+    x_max = gt[0] + shape[1] * gt[1]
+    y_min = gt[3] + shape[0] * gt[5]
+    os.system(
+        "gdal_rasterize -burn 1 -init 0 -ot Byte -te " + " ".join(str(v) for v in [x_min, y_min, x_max, y_max])
+        + " -tr " + str(abs(gt[1])) + " " + str(abs(gt[5])) + " " + shape_path + " " + mask_path)
+
+    raster = gdal.Open(mask_path)
+    if raster is None:
+        sys.exit("The shape " + os.path.basename(shape_path) + " could not be rasterized. Check the input shape file.")
+    mask = raster.GetRasterBand(1).ReadAsArray() == 1
+    raster = None
+    return mask
+
+
+def get_window_geotransform(gt, window):
+    """
+    Function gets the GEOTransform of a window of a raster.
+
+    :param gt: tuple with the GEOTransform of the raster
+    :param window: tuple with the first row, last row + 1, first column and last column + 1 of the window
+
+    :return: tuple with the GEOTransform of the window
+    """
+    return (gt[0] + window[2] * gt[1], gt[1], gt[2], gt[3] + window[0] * gt[5], gt[4], gt[5])
+
+
+def save_window_vrt(vrt_path, raster_path, mask_path, window, gt, proj, offset=None):
+    """
+    Function saves a virtual raster (.vrt) which reads a window of a raster and multiplies it with a mask raster (with
+    the size of the window), using the GDAL 'mul' pixel function. Pixels where the mask is np.nan are no data.
+
+    :param vrt_path: file path (including extension and name) with which to save the virtual raster
+    :param raster_path: file path of the raster to read the window from
+    :param mask_path: file path of the mask raster, with a value of 1 inside and np.nan outside of the shape
+    :param window: tuple with the first row, last row + 1, first column and last column + 1 of the window
+    :param gt: tuple with the GEOTransform of the raster
+    :param proj: projection for the virtual raster
+    :param offset: float, if not None the raster values are replaced by this value (raster * 0 + offset), e.g. to save
+    the total SY, which keeps the no data pixels of the raster
+
+    Note: the source paths are saved relative to the virtual raster, so the results folder can be moved.
+    """
+    gt = get_window_geotransform(gt, window)
+    x_size = window[3] - window[2]
+    y_size = window[1] - window[0]
+    dst_rect = f'<DstRect xOff="0" yOff="0" xSize="{x_size}" ySize="{y_size}"/>'
+    vrt_folder = os.path.dirname(os.path.abspath(vrt_path))
+
+    if offset is None:
+        source = "SimpleSource"
+        scaling = ""
+    else:
+        source = "ComplexSource"
+        scaling = f"\n      <ScaleOffset>{float(offset)!r}</ScaleOffset>\n      <ScaleRatio>0</ScaleRatio>"
+
+    vrt = f"""<VRTDataset rasterXSize="{x_size}" rasterYSize="{y_size}">
+  <SRS>{saxutils.escape(proj)}</SRS>
+  <GeoTransform>{", ".join(repr(float(v)) for v in gt)}</GeoTransform>
+  <VRTRasterBand dataType="Float32" band="1" subClass="VRTDerivedRasterBand">
+    <NoDataValue>nan</NoDataValue>
+    <PixelFunctionType>mul</PixelFunctionType>
+    <{source}>
+      <SourceFilename relativeToVRT="1">{saxutils.escape(os.path.relpath(raster_path, vrt_folder))}</SourceFilename>
+      <SourceBand>1</SourceBand>
+      <SrcRect xOff="{window[2]}" yOff="{window[0]}" xSize="{x_size}" ySize="{y_size}"/>
+      {dst_rect}{scaling}
+    </{source}>
+    <SimpleSource>
+      <SourceFilename relativeToVRT="1">{saxutils.escape(os.path.relpath(mask_path, vrt_folder))}</SourceFilename>
+      <SourceBand>1</SourceBand>
+      <SrcRect xOff="0" yOff="0" xSize="{x_size}" ySize="{y_size}"/>
+      {dst_rect}
+    </SimpleSource>
+  </VRTRasterBand>
+</VRTDataset>
+"""
+    with open(vrt_path, 'w') as f:
+        f.write(vrt)
+    print("Saved virtual raster: ", os.path.basename(vrt_path))
+
+
+def rasterize_polygons(polygons, gt, shape):
+    """
+    Function rasterizes polygons to the grid of the input rasters, within the bounding box of the polygons. Pixels whose
+    center is inside a polygon (even-odd rule, so holes are excluded) are inside the mask.
+
+    :param polygons: list of polygons, each a list of rings, each a list of (x, y) coordinates (as in GeoJSON)
+    :param gt: tuple with the GEOTransform of the grid
+    :param shape: tuple with the number of rows and columns of the grid
+
+    :return: tuple with the window of the mask in the grid (first row, last row + 1, first column, last column + 1) and
+    boolean np.array with the mask of the window. If the polygons are outside of the grid, the window is None.
+
+    Note: the crossings of all edges with the pixel center line of each row are calculated at once and the pixels are
+    filled between them, so the time depends on the number of edges times the number of rows in the bounding box.
+    """
+    edges = []
+    for polygon in polygons:
+        for ring in polygon:
+            ring = np.asarray(ring, dtype=float)[:, 0:2]
+            edges.append(np.hstack([ring, np.roll(ring, -1, axis=0)]))
+    edges = np.vstack(edges)  # x1, y1, x2, y2 of each edge
+
+    # Window of the bounding box (pixel centers inside the box), clipped to the grid
+    x_min, x_max = edges[:, [0, 2]].min(), edges[:, [0, 2]].max()
+    y_min, y_max = edges[:, [1, 3]].min(), edges[:, [1, 3]].max()
+    c0 = max(int(np.ceil((x_min - gt[0]) / gt[1] - 0.5)), 0)
+    c1 = min(int(np.floor((x_max - gt[0]) / gt[1] - 0.5)) + 1, shape[1])
+    r0 = max(int(np.ceil((y_max - gt[3]) / gt[5] - 0.5)), 0)
+    r1 = min(int(np.floor((y_min - gt[3]) / gt[5] - 0.5)) + 1, shape[0])
+    if r0 >= r1 or c0 >= c1:
+        return None, None
+
+    # Crossings of each edge (columns) with the pixel center line of each row (rows)
+    y = gt[3] + (np.arange(r0, r1) + 0.5) * gt[5]
+    x1, y1, x2, y2 = [edges[:, j][None, :] for j in range(0, 4)]
+    crosses = (y1 > y[:, None]) != (y2 > y[:, None])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_cross = np.where(crosses, x1 + (y[:, None] - y1) * (x2 - x1) / (y2 - y1), gt[0])
+    # Number of pixels in the window whose center is left of each crossing
+    n_left = np.clip(np.ceil((x_cross - gt[0]) / gt[1] - 0.5) - c0, 0, c1 - c0).astype(int)
+
+    # A pixel is inside if an odd number of crossings is right of its center
+    toggles = np.zeros((r1 - r0, c1 - c0 + 1), dtype=int)
+    rows, cols = np.nonzero(crosses)
+    np.add.at(toggles, (rows, 0), 1)
+    np.add.at(toggles, (rows, n_left[rows, cols]), -1)
+    mask = np.cumsum(toggles, axis=1)[:, :-1] % 2 == 1
+
+    return (r0, r1, c0, c1), mask
+
+
 def save_raster(array, output_path, gt, proj):
     """
     Function saves a np.array into a .tif raster file.
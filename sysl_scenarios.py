@@ -0,0 +1,223 @@
+"""
+Module compares land management scenarios, i.e. alternative C factor and P factor rasters (e.g. reforestation or
+terracing), over the same R factor record.
+
+Usage:
+    python sysl_scenarios.py
+
+Notes:
+* Each scenario in the 'scenarios' dictionary in config.py can set 'cp_path' (or 'c_winter_path' and 'c_summer_path'),
+    'p_path' and a factor 'schedule' (see sysl_factor_schedule). Factors which are not set by a scenario are taken from
+    the base factor schedule in config.py. Unknown settings stop the run with an ERROR.
+* Each R factor raster is read once and all scenarios are evaluated with it. The static product C*K*P*LS of each
+    scenario is kept in the factor cache, so factor_cache_mb must fit one product and its time-varying factor rasters
+    for each scenario (the run stops with an ERROR otherwise). Time-invariant factors and their partial products are
+    kept outside of the factor cache.
+* For each sub-catchment (and the total catchment), a table with the mean SL, mean SY, total SY and bed load (optional)
+    of each scenario and month is saved (NAME_Scenarios.txt).
+* Rasters are only saved for the total catchment of the scenarios and variables ('SL', 'SY', 'SY_Total') set in the
+    'scenario_rasters' dictionary in config.py, to the 'Scenarios' folder in the results folder.
+"""
+import sysl_factor_schedule as fs
+import sysl_file_management as fm
+import sysl_functions as r_calc
+import sysl_main as sysl
+import sysl_raster_calculations as rc
+from config import *
+
+SCENARIO_KEYS = ['cp_path', 'c_winter_path', 'c_summer_path', 'p_path', 'schedule']
+SCENARIO_RASTERS = ['SL', 'SY', 'SY_Total']
+
+
+def check_scenarios(scenario_list, save_rasters):
+    """
+    Function checks the settings of the scenarios and of the rasters to save, since a misspelled raster path would
+    silently give the results of the base factors.
+
+    :param scenario_list: dictionary with the name (key) and raster paths (value) of each scenario
+    :param save_rasters: dictionary with the name of a scenario (key) and a list with the variables to save (value)
+
+    Note: the function generates an ERROR if a scenario has an unknown key or factor, sets both 'cp_path' and a
+    seasonal C factor, or if save_rasters has an unknown scenario or variable.
+    """
+    for name, scenario in scenario_list.items():
+        if not isinstance(scenario, dict):
+            sys.exit("ERROR: The scenario " + str(name) + " must be a dictionary with raster paths.")
+        unknown = [key for key in scenario if key not in SCENARIO_KEYS]
+        if len(unknown) > 0:
+            sys.exit("ERROR: The scenario " + str(name) + " has unknown settings: " + ", ".join(map(str, unknown)) +
+                     ". Use " + ", ".join(SCENARIO_KEYS) + ".")
+        if 'cp_path' in scenario and ('c_winter_path' in scenario or 'c_summer_path' in scenario):
+            sys.exit("ERROR: The scenario " + str(name) + " sets cp_path and a seasonal C factor. Use only one.")
+        unknown = [factor for factor in scenario.get('schedule', {}) if factor not in fs.FACTORS]
+        if len(unknown) > 0:
+            sys.exit("ERROR: The schedule of scenario " + str(name) + " has unknown factors: " +
+                     ", ".join(map(str, unknown)) + ". Use " + ", ".join(fs.FACTORS) + ".")
+
+    for name, variables in save_rasters.items():
+        if name not in scenario_list:
+            sys.exit("ERROR: scenario_rasters contains the scenario " + str(name) + ", which is not in scenarios.")
+        unknown = [variable for variable in variables if variable not in SCENARIO_RASTERS]
+        if len(unknown) > 0:
+            sys.exit("ERROR: scenario_rasters of scenario " + str(name) + " has unknown rasters: " +
+                     ", ".join(map(str, unknown)) + ". Use " + ", ".join(SCENARIO_RASTERS) + ".")
+
+
+def get_scenario_schedule(scenario):
+    """
+    Function gets the factor schedule of a scenario. The C factor and P factor rasters of the scenario replace the ones
+    of the base factor schedule (factor_schedule and input rasters in config.py).
+
+    :param scenario: dictionary with the raster paths of the scenario (keys: 'cp_path' or 'c_winter_path' and
+    'c_summer_path', and 'p_path') and optionally a factor 'schedule', whose entries are used first
+
+    :return: dictionary, with a list of (start, end, path) entries for each factor (see sysl_factor_schedule)
+    """
+    schedule = fs.get_factor_schedule(factor_schedule)
+    if 'cp_path' in scenario:
+        schedule['C'] = [(None, None, scenario['cp_path'])]
+    elif 'c_winter_path' in scenario or 'c_summer_path' in scenario:
+        # Winter from October to March, summer from April to September. A missing season uses the base schedule.
+        schedule['C'] = [entry for entry in [('10', '03', scenario.get('c_winter_path')),
+                                             ('04', '09', scenario.get('c_summer_path'))]
+                         if entry[2] is not None] + schedule['C']
+    if 'p_path' in scenario:
+        schedule['P'] = [(None, None, scenario['p_path'])]
+    for factor, entries in scenario.get('schedule', {}).items():
+        schedule[factor] = [tuple(entry) for entry in entries] + schedule[factor]
+    return schedule
+
+
+def check_scenario_cache(schedules, shape, max_mb):
+    """
+    Function checks that the factor cache can hold the static product and the time-varying factor rasters of every
+    scenario. The scenarios are evaluated one after the other in each month, so if the cache cannot hold them, each
+    product is removed before it is used again and the rasters of every scenario are read again in every month.
+
+    :param schedules: dictionary, with the factor schedule of each scenario
+    :param shape: tuple, with the number of rows and columns of the rasters
+    :param max_mb: float, maximum memory (in MB) of the factor cache
+
+    :return: float, memory (in MB) needed by the scenarios
+
+    Note: the function generates an ERROR if the cache is too small. The time-invariant factors and their partial
+    products are kept outside of the cache (see sysl_factor_schedule) and are not included.
+    """
+    array_mb = shape[0] * shape[1] * rc.PIXEL_BYTES / 1024 ** 2  # Masked float32 array
+    needed_mb = 0
+    for name, schedule in schedules.items():
+        n_varying = len(fs.get_varying_factors(schedule))
+        if n_varying > 0:  # Product and time-varying factor rasters of the month
+            needed_mb += (1 + n_varying) * array_mb
+    if needed_mb > max_mb:
+        sys.exit("ERROR: factor_cache_mb ({} MB) is too small for the static products of the scenarios ({:.0f} MB "
+                 "needed). Increase factor_cache_mb or run fewer scenarios.".format(max_mb, needed_mb))
+    return needed_mb
+
+
+def run_scenarios(r_filenames, clip_filenames, scenario_list, save_rasters):
+    """
+    Function evaluates all scenarios for each R factor raster and gets the summary results of each scenario in each
+    watershed.
+
+    :param r_filenames: list, with the R factor raster paths within the analysis date range
+    :param clip_filenames: list, with the shape file paths
+    :param scenario_list: dictionary with the name (key) and raster paths (value) of each scenario
+    :param save_rasters: dictionary with the name of a scenario (key) and a list with the variables ('SL', 'SY',
+    'SY_Total') to save as rasters for the total catchment (value)
+
+    :return: 4D np.array with the results (watershed, scenario, month, result column) and np.array with the dates
+    """
+    check_scenarios(scenario_list, save_rasters)
+    factors, gt, proj = sysl.read_factors(r_filenames[0], save_sdr=True)
+    names = list(scenario_list.keys())
+
+    # Check the scenario rasters against the input rasters
+    schedules = {name: get_scenario_schedule(scenario_list[name]) for name in names}
+    scenario_paths = [path for name in names for path in fs.get_schedule_paths(schedules[name])]
+    rc.check_input_rasters([r_filenames[0]] + scenario_paths, pixel_area)
+
+    check_scenario_cache(schedules, factors['TT'].shape, factor_cache_mb)
+
+    masks = sysl.get_catchment_masks(clip_filenames, gt, factors['TT'].shape)
+    masks = masks.reshape(masks.shape[0], -1)
+
+    result_cols = 4 if calc_bed_load else 3
+    data = np.full((masks.shape[0], len(names), len(r_filenames), result_cols), np.nan)
+    dates_vector = np.full((len(r_filenames), 1), "", dtype=object)
+
+    i = 0  # loop for every month
+    for file, R_array in rc.prefetch_rasters(r_filenames, prefetch_depth):  # Read once for all scenarios
+        r_date = str(fm.get_date(file).strftime("%Y%m"))
+        print(r_date)
+
+        sl_stack = np.full((len(names), masks.shape[1]), np.nan, dtype=np.float32)
+        sy_stack = np.full((len(names), masks.shape[1]), np.nan, dtype=np.float32)
+        for s, name in enumerate(names):
+            static_array = fs.get_static_factors(schedules[name], factors['cache'], r_date)
+            sl_array = r_calc.calculate_sl(R_array, static_array)
+            sy_array = r_calc.calculate_sy(sl_array, factors['SDR'], pixel_area)
+            sl_stack[s] = sl_array.ravel()
+            sy_stack[s] = sy_array.ravel()
+
+            # Save the rasters requested for the scenario
+            for variable in save_rasters.get(name, []):
+                save_path = os.path.join(results_path, "Scenarios", name)
+                fm.check_folder(save_path)
+                if variable == 'SL':
+                    rc.save_raster(sl_array, os.path.join(save_path, 'SL', f'SL_{name}_{r_date}.tif'), gt, proj)
+                elif variable == 'SY':
+                    rc.save_raster(sy_array, os.path.join(save_path, 'SY', f'SY_{name}_{r_date}.tif'), gt, proj)
+                elif variable == 'SY_Total':
+                    rc.save_raster(r_calc.calculate_total_sy(sy_array),
+                                   os.path.join(save_path, 'SY_Total', f'SYTot_{name}_{r_date}.tif'), gt, proj)
+
+        # Statistics of all scenarios (rows) in each watershed (columns)
+        sl_sum, sl_count = r_calc.calculate_mask_sums(sl_stack, masks)
+        sy_sum, sy_count = r_calc.calculate_mask_sums(sy_stack, masks)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            data[:, :, i, 0] = (sl_sum / sl_count).T
+            data[:, :, i, 1] = (sy_sum / sy_count).T
+            data[:, :, i, 2] = np.where(sy_count > 0, sy_sum, np.nan).T
+            if calc_bed_load:
+                data[:, :, i, 3] = r_calc.calculate_bl(data[:, :, i, 2:3], r_date, axis=2)
+
+        dates_vector[i][0] = r_date
+        i += 1
+
+    return data, dates_vector
+
+
+def save_scenario_tables(data, dates_vector, clip_filenames, names):
+    """
+    Function saves the scenario table of each watershed.
+
+    :param data: 4D np.array with the results (watershed, scenario, month, result column)
+    :param dates_vector: np.array, with the date for each analyzed month (in string YYYYMM format)
+    :param clip_filenames: list, with the shape file paths which correspond to watersheds 1 to n in data
+    :param names: list, with the scenario names in the order of data
+    """
+    for k in range(0, int(data.shape[0])):
+        if k == 0:
+            save_path = os.path.join(results_path, "Total")
+            file_name = os.path.join(save_path, "Banja_Scenarios.txt")
+        else:  # for catchments, the file name must be is Catchment_NAME.
+            shape_name = os.path.splitext(os.path.basename(clip_filenames[k - 1])[10:])[0]
+            save_path = os.path.join(results_path, shape_name)
+            file_name = os.path.join(save_path, f'{shape_name}_Scenarios.txt')
+        fm.check_folder(save_path)
+        fm.save_scenario_table(data, k, dates_vector, names, file_name)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    start_date = fm.get_date(start_date)
+    end_date = fm.get_date(end_date)
+    fm.check_folder(results_path, additional_folders=False)
+
+    R_filenames, clip_filenames = sysl.get_input_files(r_folder, clip_path, start_date, end_date)
+    scenario_data, dates_vector = run_scenarios(R_filenames, clip_filenames, scenarios, scenario_rasters)
+    save_scenario_tables(scenario_data, dates_vector, clip_filenames, list(scenarios.keys()))
+
+    print('Total time: ', time.time() - start_time)
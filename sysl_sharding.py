@@ -0,0 +1,423 @@
+"""
+Module runs the model in sharded mode, in which the analysis period (and optionally the sub-catchments) is split into
+work units that are calculated by workers on several nodes and then merged to the usual summary tables.
+
+Usage (all nodes must read the same config.py and have access to queue_path and results_path):
+
+    python sysl_sharding.py plan              -> splits the R factor rasters and shapes into work units
+    python sysl_sharding.py work [worker_id]  -> claims and calculates work units until none are left
+    python sysl_sharding.py merge             -> assembles the summary tables from the partial results
+
+Notes:
+* The work queue is a folder with the following structure:
+    - plan.json: analysis date range, input files and list of work units
+    - units/: one .json file per work unit, with the R factor rasters (months) and shapes (catchments) to calculate
+    - leases/: one .lock file per claimed work unit, with a unique token of the lease. A lease is renewed after each
+        month and expires after lease_time
+    - partial/: one .npz file per finished work unit, with the rows of the 3D summary array for the unit
+* Lock files are created with an exclusive create, which is atomic on local and NFS (v3+) file systems. If a worker
+    dies, its lease expires and the work unit is claimed by another worker. Workers only renew or release a lease whose
+    lock file still has their token, and stop calculating a work unit whose lease was taken over by another worker.
+* The input rasters are checked and the result folders are created when the work units are planned, so workers which
+    start at the same time do not create the folders concurrently. Workers do not ask the user whether to continue if
+    the projections are different, since they run without input on other nodes.
+* If temporal_statistics is True, the long-term statistics of each pixel are calculated in the merge step from the
+    saved SL and SY rasters of the total catchment (see sysl_statistics).
+* The total catchment rasters are only saved by the work units with the first set of catchments. Work units with other
+    catchment sets save them to a scratch folder in the queue, which is deleted after the unit is finished.
+"""
+import sysl_file_management as fm
+import sysl_main as sysl
+import sysl_raster_calculations as rc
+import sysl_statistics as st
+from config import *
+
+
+def get_queue_folders(queue_path):
+    """
+    Function gets the sub-folders of the work queue and creates them, if they do not exist.
+
+    :param queue_path: string, folder path of the work queue
+
+    :return: dictionary with the folder paths for the 'units', 'leases', 'partial' and 'scratch' sub-folders
+    """
+    folders = {}
+    for name in ['units', 'leases', 'partial', 'scratch']:
+        folders[name] = os.path.join(queue_path, name)
+        if not os.path.exists(folders[name]):
+            os.makedirs(folders[name], exist_ok=True)
+    return folders
+
+
+def plan_work_units(queue_path, r_filenames, clip_filenames, start_date, end_date, n_months, n_catchments):
+    """
+    Function splits the R factor rasters (months) and the clipping shapes (catchments) into work units and saves them
+    to the work queue.
+
+    :param queue_path: string, folder path of the work queue
+    :param r_filenames: list, with the R factor raster paths within the analysis date range
+    :param clip_filenames: list, with the shape file paths
+    :param start_date: datetime variable, analysis start date
+    :param end_date: datetime variable, analysis end date
+    :param n_months: int, number of months in each work unit
+    :param n_catchments: int, number of shapes in each work unit (if 0, all shapes are in one work unit). If virtual
+    rasters are saved for the catchments (output_mode 'vrt'), all shapes are in one work unit, since the catchments
+    read the total catchment rasters of the same work unit.
+
+    :return: list, with the names of the work units
+
+    Note: the function generates an ERROR if the work queue already contains a plan, to avoid mixing partial results
+    of different runs.
+    """
+    plan_file = os.path.join(queue_path, 'plan.json')
+    if os.path.exists(plan_file):
+        sys.exit("ERROR: The work queue " + queue_path + " already contains a plan. Delete it or use another " +
+                 "queue_path.")
+    folders = get_queue_folders(queue_path)
+
+    if n_catchments <= 0 or n_catchments > len(clip_filenames) or output_mode == 'vrt':
+        n_catchments = max(len(clip_filenames), 1)
+    catchment_sets = [list(range(j, min(j + n_catchments, len(clip_filenames))))
+                      for j in range(0, max(len(clip_filenames), 1), n_catchments)]
+
+    units = []
+    for row in range(0, len(r_filenames), n_months):
+        rows = list(range(row, min(row + n_months, len(r_filenames))))
+        for j, catchments in enumerate(catchment_sets):
+            unit = {'name': f'unit_{len(units):05d}',
+                    'rows': rows,
+                    'r_files': [r_filenames[i] for i in rows],
+                    'catchment_set': j,
+                    'catchments': catchments}
+            with open(os.path.join(folders['units'], unit['name'] + '.json'), 'w') as f:
+                json.dump(unit, f, indent=1)
+            units.append(unit['name'])
+
+    plan = {'start_date': start_date.strftime('%Y%m'),
+            'end_date': end_date.strftime('%Y%m'),
+            'r_files': r_filenames,
+            'clip_files': clip_filenames,
+            'units': units}
+    with open(plan_file, 'w') as f:
+        json.dump(plan, f, indent=1)
+    print("Work units planned: ", len(units))
+
+    return units
+
+
+def read_plan(queue_path):
+    """
+    Function reads the plan of the work queue.
+
+    :param queue_path: string, folder path of the work queue
+
+    :return: dictionary with the plan data (see function 'plan_work_units')
+    """
+    plan_file = os.path.join(queue_path, 'plan.json')
+    if not os.path.exists(plan_file):
+        sys.exit("ERROR: There is no plan in the work queue " + queue_path +
+                 ". Run 'python sysl_sharding.py plan' first.")
+    with open(plan_file) as f:
+        return json.load(f)
+
+
+def read_lock(lock_file):
+    """
+    Function reads the token and the modification time of a lock file.
+
+    :param lock_file: string, path of the lock file
+
+    :return: tuple with the token (string) and the modification time (float), or (None, None) if the lock file does not
+    exist
+    """
+    try:
+        with open(lock_file) as f:
+            token = f.read().strip()
+        return token, os.path.getmtime(lock_file)
+    except FileNotFoundError:
+        return None, None
+
+
+def create_lock(lock_file, token):
+    """
+    Function creates a lock file with a token, if it does not exist. The exclusive create is atomic, so only one worker
+    can create the lock file.
+
+    :param lock_file: string, path of the lock file
+    :param token: string, unique token of the lease, which is written to the lock file
+
+    :return: boolean, True if the lock file was created
+    """
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+    return True
+
+
+def break_expired_lease(lock_file, worker_id, lease):
+    """
+    Function removes the lock file of an expired lease. The lock file is first renamed, which is atomic, so only one
+    worker can take it over. If the renamed lock file is not the expired one (another worker broke the lease and created
+    a new lock file between the check and the rename), it is put back.
+
+    :param lock_file: string, path of the lock file
+    :param worker_id: string, name of the worker
+    :param lease: float, time (in seconds) after which a lease that was not renewed is expired
+    """
+    token, mtime = read_lock(lock_file)
+    if token is None or time.time() - mtime <= lease:
+        return
+    stale_file = lock_file + '.' + worker_id + '.stale'
+    try:
+        os.rename(lock_file, stale_file)
+    except FileNotFoundError:
+        return  # Another worker broke the lease first
+    if read_lock(stale_file) == (token, mtime):
+        os.remove(stale_file)
+        print("Expired lease of work unit: ", os.path.splitext(os.path.basename(lock_file))[0])
+        return
+    # The lock file is a new lease: put it back, unless another lock file was created in the meantime (in which case the
+    # owner of the new lease notices it when renewing the lease)
+    try:
+        os.link(stale_file, lock_file)
+    except FileExistsError:
+        pass
+    os.remove(stale_file)
+
+
+def claim_work_unit(queue_path, worker_id, lease):
+    """
+    Function claims the first work unit which is not finished and has no valid lease, by creating its lock file with a
+    unique token.
+
+    :param queue_path: string, folder path of the work queue
+    :param worker_id: string, name of the worker, which is written to the lock file
+    :param lease: float, time (in seconds) after which a lease that was not renewed is expired
+
+    :return: dictionary with the work unit data and the 'token' of the lease, or None if there are no work units left
+    to claim
+    """
+    folders = get_queue_folders(queue_path)
+    for name in read_plan(queue_path)['units']:
+        if os.path.exists(os.path.join(folders['partial'], name + '.npz')):
+            continue  # Work unit is finished
+        lock_file = os.path.join(folders['leases'], name + '.lock')
+        break_expired_lease(lock_file, worker_id, lease)
+
+        token = f'{worker_id} {uuid.uuid4().hex}'
+        if not create_lock(lock_file, token):
+            continue  # Work unit is claimed by another worker
+
+        # Check again, in case the work unit was finished between the first check and the lease
+        if os.path.exists(os.path.join(folders['partial'], name + '.npz')):
+            release_lease(queue_path, name, token)
+            continue
+        with open(os.path.join(folders['units'], name + '.json')) as f:
+            unit = json.load(f)
+        unit['token'] = token
+        return unit
+    return None
+
+
+def renew_lease(queue_path, unit_name, token):
+    """
+    Function renews the lease of a work unit, by updating the modification time of its lock file, if the lock file still
+    has the token of the lease.
+
+    :param queue_path: string, folder path of the work queue
+    :param unit_name: string, name of the work unit
+    :param token: string, token of the lease (from function 'claim_work_unit')
+
+    :return: boolean, True if the lease was renewed, False if the lease expired and the work unit was claimed by
+    another worker
+    """
+    lock_file = os.path.join(queue_path, 'leases', unit_name + '.lock')
+    lock_token, mtime = read_lock(lock_file)
+    if lock_token is None:  # Lease expired and was broken, but the work unit was not claimed again yet
+        return create_lock(lock_file, token)
+    if lock_token != token:
+        return False
+    os.utime(lock_file)
+    return True
+
+
+def release_lease(queue_path, unit_name, token):
+    """
+    Function removes the lock file of a work unit, if it still has the token of the lease.
+
+    :param queue_path: string, folder path of the work queue
+    :param unit_name: string, name of the work unit
+    :param token: string, token of the lease (from function 'claim_work_unit')
+    """
+    lock_file = os.path.join(queue_path, 'leases', unit_name + '.lock')
+    if read_lock(lock_file)[0] == token:
+        os.remove(lock_file)
+
+
+def complete_work_unit(queue_path, unit, data, dates):
+    """
+    Function saves the partial results of a work unit and releases its lease.
+
+    :param queue_path: string, folder path of the work queue
+    :param unit: dictionary with the work unit data
+    :param data: 3D np.array, with the total catchment and the catchments of the unit for the months of the unit
+    :param dates: list, with the dates (YYYYMM) of the months of the unit
+
+    Note: the partial results are first written to a temporary file and then renamed, so an incomplete .npz file is
+    never considered as a finished work unit.
+    """
+    partial_file = os.path.join(queue_path, 'partial', unit['name'] + '.npz')
+    temp_file = partial_file + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_file, 'wb') as f:
+        np.savez(f, data=data, rows=np.array(unit['rows']), catchments=np.array(unit['catchments'], dtype=int),
+                 catchment_set=unit['catchment_set'], dates=np.array(dates))
+    os.replace(temp_file, partial_file)
+    release_lease(queue_path, unit['name'], unit['token'])
+    print("Finished work unit: ", unit['name'])
+
+
+def run_worker(queue_path, worker_id, lease):
+    """
+    Function claims and calculates work units until all work units are finished or claimed by other workers.
+
+    :param queue_path: string, folder path of the work queue
+    :param worker_id: string, name of the worker
+    :param lease: float, time (in seconds) after which a lease that was not renewed is expired
+
+    :return: int, number of work units calculated by the worker
+    """
+    plan = read_plan(queue_path)
+    clip_filenames = plan['clip_files']
+
+    # The input rasters were checked (and different projections accepted) and the SDR raster was saved when the work
+    # units were planned
+    factors, gt, proj = sysl.read_factors(plan['r_files'][0], save_sdr=False, interactive=False)
+
+    n_units = 0
+    unit = claim_work_unit(queue_path, worker_id, lease)
+    while unit is not None:
+        print(worker_id, "calculating work unit: ", unit['name'])
+        unit_clip = [clip_filenames[j] for j in unit['catchments']]
+        if unit['catchment_set'] == 0:
+            total_path = os.path.join(results_path, "Total")
+        else:
+            total_path = os.path.join(queue_path, 'scratch', unit['name'])
+
+        if output_mode == 'vrt':  # Cutline masks were saved when the work units were planned
+            catchment_windows = sysl.get_catchment_windows(unit_clip, gt, proj, factors['TT'].shape)
+        else:
+            catchment_windows = None
+
+        data = sysl.create_summary_array(len(unit_clip), len(unit['rows']))
+        dates = []
+        i = 0
+        leased = True
+        for file, R_array in rc.prefetch_rasters(unit['r_files'], prefetch_depth):
+            dates.append(sysl.calculate_month(file, i, data, factors, unit_clip, gt, proj, total_path, R_array,
+                                              catchment_windows=catchment_windows))
+            i += 1
+            leased = renew_lease(queue_path, unit['name'], unit['token'])
+            if not leased:  # The work unit was claimed by another worker, which calculates it again
+                print(worker_id, "lost the lease of work unit: ", unit['name'])
+                break
+
+        if leased:
+            complete_work_unit(queue_path, unit, data, dates)
+            n_units += 1
+        if unit['catchment_set'] != 0:
+            shutil.rmtree(total_path, ignore_errors=True)
+        unit = claim_work_unit(queue_path, worker_id, lease)
+
+    print(worker_id, "finished. Work units calculated: ", n_units)
+    return n_units
+
+
+def merge_partial_results(queue_path):
+    """
+    Function assembles the 3D summary array from the partial results of all work units and checks that every month of
+    the analysis period was calculated for the total catchment and each sub-catchment.
+
+    :param queue_path: string, folder path of the work queue
+
+    :return: 3D np.array with the summary results, np.array with the dates and list with the shape file paths
+
+    Note: the function generates an ERROR if a work unit is not finished or if the number of merged months is different
+    from the number of months expected by 'filter_raster_lists' for the analysis date range.
+    """
+    plan = read_plan(queue_path)
+    clip_filenames = plan['clip_files']
+    n_months = len(plan['r_files'])
+
+    missing = [name for name in plan['units']
+               if not os.path.exists(os.path.join(queue_path, 'partial', name + '.npz'))]
+    if len(missing) > 0:
+        sys.exit("ERROR: The following work units are not finished: " + ", ".join(missing))
+
+    data_summary = None
+    covered = np.full((len(clip_filenames) + 1, n_months), False)
+    dates_vector = np.full((n_months, 1), "", dtype=object)
+    for name in plan['units']:
+        with np.load(os.path.join(queue_path, 'partial', name + '.npz')) as partial:
+            data = partial['data']
+            rows = partial['rows']
+            if data_summary is None:
+                data_summary = np.full((len(clip_filenames) + 1, n_months, data.shape[2]), np.nan)
+            # The total catchment (array 0) is only taken from the first catchment set
+            if int(partial['catchment_set']) == 0:
+                data_summary[0, rows, :] = data[0]
+                covered[0, rows] = True
+            for j, k in enumerate(partial['catchments']):
+                data_summary[k + 1, rows, :] = data[j + 1]
+                covered[k + 1, rows] = True
+            dates_vector[rows, 0] = partial['dates']
+
+    # Check completeness against the months of the analysis date range: every month must be merged for all catchments
+    start_date = fm.get_date(plan['start_date'])
+    end_date = fm.get_date(plan['end_date'])
+    n_expected = (end_date.year - start_date.year) * 12 + end_date.month - start_date.month + 1
+    expected = [f'{(start_date.month - 1 + j) // 12 + start_date.year}{(start_date.month - 1 + j) % 12 + 1:02d}'
+                for j in range(0, n_expected)]
+    merged = set(dates_vector[covered.all(axis=0), 0])
+    missing = [date for date in expected if date not in merged]
+    if len(missing) > 0 or not covered.all():
+        sys.exit("ERROR: The partial results cover {} of {} expected month(s) for all catchments. Missing: {}".format(
+            n_expected - len(missing), n_expected, ", ".join(missing)))
+
+    return data_summary, dates_vector, clip_filenames
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+
+    if command == 'plan':
+        start_date = fm.get_date(start_date)
+        end_date = fm.get_date(end_date)
+        fm.check_folder(results_path, additional_folders=False)
+        R_filenames, clip_filenames = sysl.get_input_files(r_folder, clip_path, start_date, end_date)
+        # Check the input rasters and save the SDR raster and the cutline masks once
+        factors, gt, proj = sysl.read_factors(R_filenames[0], save_sdr=True)
+        sysl.create_result_folders(clip_filenames)
+        if output_mode == 'vrt':
+            sysl.get_catchment_windows(clip_filenames, gt, proj, factors['TT'].shape)
+        plan_work_units(queue_path, R_filenames, clip_filenames, start_date, end_date, months_per_unit,
+                        catchments_per_unit)
+    elif command == 'work':
+        if len(sys.argv) > 2:
+            worker = sys.argv[2]
+        else:
+            worker = f'{socket.gethostname()}_{os.getpid()}'
+        run_worker(queue_path, worker, lease_time)
+    elif command == 'merge':
+        data_summary, dates_vector, clip_filenames = merge_partial_results(queue_path)
+        sysl.save_summary_tables(data_summary, dates_vector, clip_filenames)
+        if temporal_statistics:  # The months were calculated by several workers: use the saved rasters
+            st.save_result_statistics(results_path, list(dates_vector[:, 0]), statistics_thresholds,
+                                      statistics_quantiles, prefetch_depth)
+    else:
+        sys.exit("Usage: python sysl_sharding.py plan | work [worker_id] | merge")
+
+    print('Total time: ', time.time() - start_time)
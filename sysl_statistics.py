@@ -0,0 +1,197 @@
+"""
+Module contains functions to calculate the long-term statistics of each pixel over the analysis period (mean, standard
+deviation, maximum, threshold exceedance frequency and quantiles) with online accumulators, which are updated with the
+raster of each month. The memory of an accumulator does not depend on the number of months.
+
+The statistics are calculated as follows:
+* Mean and standard deviation: Welford's algorithm
+    Welford, B.P., 1962. Note on a method for calculating corrected sums of squares and products. Technometrics 4(3),
+    419–420. https://doi.org/10.1080/00401706.1962.10490022
+* Quantiles (optional): P-square algorithm, which estimates each quantile with 5 markers per pixel
+    Jain, R., Chlamtac, I., 1985. The P2 algorithm for dynamic calculation of quantiles and histograms without storing
+    observations. Communications of the ACM 28(10), 1076–1085. https://doi.org/10.1145/4372.4378
+
+Notes:
+* Modes in which the months are calculated in several processes (sharded or batch execution) calculate the statistics
+    from the saved SL and SY rasters of the total catchment after all months are calculated (function
+    'save_result_statistics').
+* np.nan pixels are not counted, so the statistics of each pixel only include the months in which it has a value.
+* Until a pixel has 5 values, its quantiles are calculated from the stored values.
+"""
+import sysl_raster_calculations as rc
+from config import *
+
+
+def create_accumulator(shape, thresholds, quantiles):
+    """
+    Function creates an empty accumulator for the statistics of each pixel.
+
+    :param shape: tuple, with the number of rows and columns of the rasters
+    :param thresholds: list, with the values whose exceedance frequency is calculated
+    :param quantiles: list, with the quantiles (in %) to estimate (if empty, no quantiles are estimated)
+
+    :return: dictionary with the number of values ('n'), the mean ('mean'), the sum of squared differences from the
+    mean ('m2'), the maximum ('max') and the number of values above each threshold ('exceed') of each pixel, and the
+    marker heights ('q'), marker positions ('pos') and desired marker positions ('desired') for each quantile
+    """
+    n_quantiles = len(quantiles)
+    return {'n': np.zeros(shape, dtype=np.int32),
+            'mean': np.zeros(shape),
+            'm2': np.zeros(shape),
+            'max': np.full(shape, -np.inf),
+            'thresholds': list(thresholds),
+            'exceed': np.zeros((len(thresholds),) + tuple(shape), dtype=np.int32),
+            'quantiles': list(quantiles),
+            'q': np.full((n_quantiles, 5) + tuple(shape), np.nan),
+            'pos': np.tile(np.arange(1, 6, dtype=float).reshape((1, 5) + (1,) * len(shape)),
+                           (n_quantiles, 1) + tuple(shape)),
+            'desired': np.zeros((n_quantiles, 5) + tuple(shape))}
+
+
+def update_p2_markers(q, pos, desired, p, x, valid):
+    """
+    Function updates the P-square markers of one quantile with a new value of each pixel, for the pixels which already
+    have 5 values (the marker heights are initialized).
+
+    :param q: np.array with the 5 marker heights of each pixel (modified)
+    :param pos: np.array with the 5 marker positions of each pixel (modified)
+    :param desired: np.array with the 5 desired marker positions of each pixel (modified)
+    :param p: float, quantile (between 0 and 1)
+    :param x: np.array with the new value of each pixel
+    :param valid: boolean np.array, True for the pixels to update
+    """
+    q_v = q[:, valid]
+    pos_v = pos[:, valid]
+    x_v = x[valid]
+
+    # Adjust the extreme markers and get the cell k of the new value (q[k] <= x < q[k+1])
+    q_v[0] = np.minimum(q_v[0], x_v)
+    q_v[4] = np.maximum(q_v[4], x_v)
+    k = (x_v[None, :] >= q_v[1:4]).sum(axis=0)
+
+    # Increment the positions of the markers above the cell and the desired positions
+    pos_v += (np.arange(5)[:, None] > k[None, :])
+    desired[:, valid] += np.array([0, p / 2, p, (1 + p) / 2, 1])[:, None]
+    desired_v = desired[:, valid]
+
+    # Adjust the heights of the 3 middle markers, if they are more than one position away from the desired position
+    for i in range(1, 4):
+        d = desired_v[i] - pos_v[i]
+        move = ((d >= 1) & (pos_v[i + 1] - pos_v[i] > 1)) | ((d <= -1) & (pos_v[i - 1] - pos_v[i] < -1))
+        d = np.where(move, np.sign(d), 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            parabolic = q_v[i] + d / (pos_v[i + 1] - pos_v[i - 1]) * (
+                    (pos_v[i] - pos_v[i - 1] + d) * (q_v[i + 1] - q_v[i]) / (pos_v[i + 1] - pos_v[i])
+                    + (pos_v[i + 1] - pos_v[i] - d) * (q_v[i] - q_v[i - 1]) / (pos_v[i] - pos_v[i - 1]))
+            neighbour = np.where(d > 0, i + 1, i - 1)
+            q_n = np.take_along_axis(q_v, neighbour[None, :], axis=0)[0]
+            pos_n = np.take_along_axis(pos_v, neighbour[None, :], axis=0)[0]
+            linear = q_v[i] + d * (q_n - q_v[i]) / (pos_n - pos_v[i])
+        new_q = np.where((q_v[i - 1] < parabolic) & (parabolic < q_v[i + 1]), parabolic, linear)
+        q_v[i] = np.where(move, new_q, q_v[i])
+        pos_v[i] += d
+
+    q[:, valid] = q_v
+    pos[:, valid] = pos_v
+
+
+def update_accumulator(acc, array):
+    """
+    Function updates the accumulator with the raster values of one month.
+
+    :param acc: dictionary, from function 'create_accumulator' (modified)
+    :param array: np.array with the values of the month (np.nan pixels are not counted)
+    """
+    x = np.asarray(array, dtype=float)
+    valid = ~np.isnan(x)
+    x0 = np.where(valid, x, 0)
+
+    # Welford update of the mean and the sum of squared differences
+    acc['n'] += valid
+    delta = np.where(valid, x0 - acc['mean'], 0)
+    acc['mean'] += np.where(valid, delta / np.maximum(acc['n'], 1), 0)
+    acc['m2'] += np.where(valid, delta * (x0 - acc['mean']), 0)
+
+    acc['max'] = np.where(valid, np.maximum(acc['max'], x0), acc['max'])
+    for t in range(0, len(acc['thresholds'])):
+        acc['exceed'][t] += valid & (x0 > acc['thresholds'][t])
+
+    for j in range(0, len(acc['quantiles'])):
+        p = acc['quantiles'][j] / 100
+        q = acc['q'][j]
+        # Store the first 5 values of each pixel and sort them when the 5th value is added
+        for m in range(0, 5):
+            store = valid & (acc['n'] == m + 1)
+            q[m][store] = x0[store]
+        init = valid & (acc['n'] == 5)
+        q[:, init] = np.sort(q[:, init], axis=0)
+        acc['desired'][j][:, init] = np.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5])[:, None]
+        update_p2_markers(q, acc['pos'][j], acc['desired'][j], p, x0, valid & (acc['n'] > 5))
+
+
+def get_statistics(acc):
+    """
+    Function gets the statistics of each pixel from the accumulator.
+
+    :param acc: dictionary, from function 'create_accumulator'
+
+    :return: dictionary with an np.array for each statistic ('mean', 'std', 'max', 'exceed_THRESHOLD' and
+    'Q{quantile}'), with np.nan for the pixels without values
+    """
+    n = acc['n']
+    no_data = n == 0
+    stats = {'mean': np.where(no_data, np.nan, acc['mean']),
+             'std': np.where(n > 1, np.sqrt(acc['m2'] / np.maximum(n - 1, 1)), np.nan),
+             'max': np.where(no_data, np.nan, acc['max'])}
+    for t in range(0, len(acc['thresholds'])):
+        # Frequency of the months in which the threshold is exceeded
+        stats[f'exceed_{acc["thresholds"][t]:g}'] = np.where(no_data, np.nan, acc['exceed'][t] / np.maximum(n, 1))
+    for j in range(0, len(acc['quantiles'])):
+        q = acc['q'][j]
+        # Pixels with less than 5 values: quantile of the stored values
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # All-np.nan pixels
+            few = np.nanpercentile(q, acc['quantiles'][j], axis=0)
+        stats[f'Q{acc["quantiles"][j]:g}'] = np.where(n > 5, q[2], np.where(no_data, np.nan, few))
+    return stats
+
+
+def save_statistics(accumulators, save_path, gt, proj):
+    """
+    Function saves the statistics of each accumulator as rasters (NAME_statistic.tif).
+
+    :param accumulators: dictionary, with the name of the variable (e.g. 'SL', 'SY') and its accumulator
+    :param save_path: string, folder path where to save the rasters
+    :param gt: tuple with GEOTransform data with which to save the rasters
+    :param proj: tuple with projection data with which to save the rasters
+    """
+    if not os.path.exists(save_path):
+        print("Creating folder: ", save_path)
+        os.makedirs(save_path)
+    for name, acc in accumulators.items():
+        for statistic, array in get_statistics(acc).items():
+            rc.save_raster(array, os.path.join(save_path, f'{name}_{statistic}.tif'), gt, proj)
+
+
+def save_result_statistics(results_path, r_dates, thresholds, quantiles, depth):
+    """
+    Function calculates the statistics of each pixel from the saved SL and SY rasters of the total catchment and saves
+    them to the 'Statistics' folder in the results folder. Only one accumulator is kept in memory at a time.
+
+    :param results_path: string, path of the results folder
+    :param r_dates: list, with the dates (YYYYMM) of the analyzed months
+    :param thresholds: dictionary, with the thresholds of 'SL' and 'SY' whose exceedance frequency is calculated
+    :param quantiles: list, with the quantiles (in %) to estimate
+    :param depth: int, number of rasters read ahead on a background thread (see function 'prefetch_rasters')
+    """
+    total_path = os.path.join(results_path, "Total")
+    rasters = {'SL': [os.path.join(total_path, 'SL', f'SL_Banja_{r_date}_Total.tif') for r_date in r_dates],
+               'SY': [os.path.join(total_path, 'SY', f'SY_Banja_{r_date}.tif') for r_date in r_dates]}
+    gt, proj = rc.get_raster_data(rasters['SL'][0])
+    for name in ['SL', 'SY']:
+        acc = None
+        for file, array in rc.prefetch_rasters(rasters[name], depth):
+            if acc is None:
+                acc = create_accumulator(array.shape, thresholds.get(name, []), quantiles)
+            update_accumulator(acc, array.filled(np.nan))
+        save_statistics({name: acc}, os.path.join(results_path, "Statistics"), gt, proj)
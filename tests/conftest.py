@@ -0,0 +1,129 @@
+"""
+Fixtures for the tests, which replace the GDAL raster input and output with .npy files, so the tests run without GDAL.
+"""
+import json
+import os
+import sys
+import types
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import gdal  # noqa: F401
+except ModuleNotFoundError:  # The rasters are replaced by the fake_rasters fixture
+    sys.modules['gdal'] = types.ModuleType('gdal')
+
+import sysl_main as sysl  # noqa: E402
+import sysl_raster_calculations as rc  # noqa: E402
+
+SHAPE = (12, 16)
+GT = (1000.0, 25.0, 0.0, 5000.0, 0.0, -25.0)
+
+
+def save_raster(array, output_path, gt, proj):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temp_path = output_path + '.' + str(os.getpid()) + '.tmp.npy'
+    np.save(temp_path, np.ma.filled(np.ma.asarray(array, dtype=np.float32), np.nan))
+    os.replace(temp_path, output_path + '.npy')
+    with open(output_path + '.json', 'w') as f:  # Header of the raster
+        json.dump({'gt': list(gt), 'proj': proj}, f)
+    open(output_path, 'w').close()  # The raster path exists, as with GDAL
+
+
+def get_raster_data(raster_path):
+    if os.path.exists(raster_path + '.json'):
+        with open(raster_path + '.json') as f:
+            header = json.load(f)
+        return tuple(header['gt']), header['proj']
+    return GT, 'PROJ'
+
+
+def get_raster_size(raster_path):
+    if os.path.exists(raster_path + '.npy'):
+        return np.load(raster_path + '.npy', mmap_mode='r').shape
+    return SHAPE
+
+
+def raster_to_array(raster_path):
+    if os.path.exists(raster_path + '.npy'):
+        return np.ma.masked_invalid(np.load(raster_path + '.npy'))
+    # Input rasters: random values which only depend on the file name, with a no data corner
+    rng = np.random.default_rng(zlib.crc32(os.path.basename(raster_path).encode()))
+    array = (rng.random(SHAPE) + 0.1).astype(np.float32)
+    array[0, :3] = np.nan
+    return np.ma.masked_invalid(array)
+
+
+def get_shape_mask(shape):
+    mask = np.zeros(shape, dtype=bool)
+    mask[2:9, 3:12] = True
+    mask[2, 3] = False
+    return mask
+
+
+def rasterize_shape(shape_path, mask_path, gt, shape):
+    mask = get_shape_mask(shape)
+    save_raster(mask.astype(np.float32), mask_path, gt, 'PROJ')
+    return mask
+
+
+def clip_raster(original_raster, clipped_path, shape_path):
+    # Crops the raster to the window of the shape mask (see rasterize_shape), with no data outside of the shape
+    mask = get_shape_mask(SHAPE)[2:9, 3:12]
+    array = np.where(mask, raster_to_array(original_raster).filled(np.nan)[2:9, 3:12], np.nan)
+    save_raster(array, clipped_path, rc.get_window_geotransform(GT, (2, 9, 3, 12)), 'PROJ')
+
+
+def create_inputs(path, n_months, catchments=('A', 'B')):
+    """
+    Creates the (empty) R factor rasters of n_months months from 201601 and the shape files of the catchments.
+
+    :return: R factor folder and shape folder
+    """
+    r_folder = os.path.join(path, 'R')
+    clip_path = os.path.join(path, 'clip')
+    os.makedirs(r_folder)
+    os.makedirs(clip_path)
+    for month in range(1, n_months + 1):
+        open(os.path.join(r_folder, f'Rfactor_{2016 + (month - 1) // 12}{(month - 1) % 12 + 1:02d}.tif'), 'w').close()
+    for name in catchments:
+        open(os.path.join(clip_path, f'Catchment_{name}.shp'), 'w').close()
+    return r_folder, clip_path
+
+
+def run_sequential(r_files, clip_files, total_path=None, accumulators=None):
+    """
+    Calculates the months one by one in one process, as sysl_main.py does, with the settings of sysl_main.
+
+    :return: 3D summary array and dates vector
+    """
+    factors, gt, proj = sysl.read_factors(r_files[0], save_sdr=False)
+    if sysl.output_mode == 'vrt':
+        windows = sysl.get_catchment_windows(clip_files, gt, proj, factors['TT'].shape)
+    else:
+        windows = None
+    if total_path is None:
+        total_path = os.path.join(sysl.results_path, 'Total')
+    data = sysl.create_summary_array(len(clip_files), len(r_files))
+    dates = np.full((len(r_files), 1), "", dtype=object)
+    for i, file in enumerate(r_files):
+        dates[i, 0] = sysl.calculate_month(file, i, data, factors, clip_files, gt, proj, total_path,
+                                           accumulators=accumulators, catchment_windows=windows)
+    return data, dates
+
+
+@pytest.fixture
+def fake_rasters(monkeypatch):
+    """
+    Replaces the GDAL functions of sysl_raster_calculations with .npy files next to the raster paths.
+    """
+    monkeypatch.setattr(rc, 'save_raster', save_raster)
+    monkeypatch.setattr(rc, 'raster_to_array', raster_to_array)
+    monkeypatch.setattr(rc, 'rasterize_shape', rasterize_shape)
+    monkeypatch.setattr(rc, 'clip_raster', clip_raster)
+    monkeypatch.setattr(rc, 'get_raster_data', get_raster_data)
+    monkeypatch.setattr(rc, 'get_raster_size', get_raster_size)
+    monkeypatch.setattr(rc, 'check_input_rasters', lambda list_rasters, input_area, interactive=True: (GT, 'PROJ'))
@@ -0,0 +1,163 @@
+"""
+Tests of the batch of study areas (sysl_batch.py) on one pool of worker processes.
+"""
+import os
+import sys
+
+import pytest
+
+import config
+import sysl_batch as sb
+import sysl_factor_schedule as fs
+import sysl_main as sysl
+import sysl_raster_calculations as rc
+from conftest import GT, create_inputs, run_sequential
+
+
+@pytest.fixture(autouse=True)
+def restore_settings(monkeypatch):
+    """
+    Restores the module-level settings which are changed by apply_settings in the test process.
+    """
+    modules = [module for name, module in list(sys.modules.items()) if name == 'config' or name.startswith('sysl_')]
+    for module in modules:
+        for name in list(sb.BASE_SETTINGS) + sb.OPTIONAL_SETTINGS:
+            if hasattr(module, name):
+                monkeypatch.setattr(module, name, getattr(module, name))
+            else:
+                monkeypatch.setattr(module, name, None, raising=False)
+                monkeypatch.delattr(module, name)
+
+
+@pytest.fixture
+def basins(tmp_path, fake_rasters):
+    """
+    Creates the input files of two basins with 7 months and 2 catchments each, in jobs of 2 months.
+    """
+    basins = []
+    for name, seasonal in [('North', True), ('South', False)]:
+        r_folder, clip_path = create_inputs(str(tmp_path / name), 7)
+        settings = {'name': name, 'r_folder': r_folder, 'clip_path': clip_path,
+                    'results_path': str(tmp_path / name / 'results'), 'start_date': '201601', 'end_date': '201607',
+                    'k_path': f'{name}_K.tif', 'ls_path': f'{name}_LS.tif', 'p_path': f'{name}_P.tif',
+                    'tt_path': f'{name}_TT.tif', 'seasonal_cfactor': seasonal, 'months_per_unit': 2,
+                    'output_mode': 'vrt', 'prefetch_depth': 0}
+        if seasonal:
+            settings.update({'c_winter_path': f'{name}_C_winter.tif', 'c_summer_path': f'{name}_C_summer.tif'})
+        else:
+            settings['cp_path'] = f'{name}_C.tif'
+        basin = dict(sb.BASE_SETTINGS)
+        basin.update(settings)
+        basins.append(basin)
+    return basins
+
+
+def run_basin_sequential(settings):
+    """
+    Calculates all months of a basin in one process, as sysl_main.py does, and saves its summary tables.
+    """
+    sb.apply_settings(settings)
+    r_files, clip_files = sysl.get_input_files(settings['r_folder'], settings['clip_path'],
+                                               sysl.fm.get_date(settings['start_date']),
+                                               sysl.fm.get_date(settings['end_date']))
+    sysl.fm.check_folder(settings['results_path'], additional_folders=False)
+    sysl.create_result_folders(clip_files)
+    data, dates = run_sequential(r_files, clip_files)
+    sysl.save_summary_tables(data, dates, clip_files)
+
+
+def read_table(results_path):
+    with open(os.path.join(results_path, 'Total', 'BanjaResults.txt')) as f:
+        return f.read()
+
+
+def test_batch_matches_sequential_runs(tmp_path, basins):
+    report_path = str(tmp_path / 'batch_report.txt')
+    report = sb.run_batch(basins, 3, 0, report_path)
+    assert [basin['Status'] for basin in report] == ['done', 'done'], report
+    assert os.path.exists(report_path)
+
+    for basin in basins:
+        sequential = dict(basin, results_path=basin['results_path'] + '_sequential')
+        run_basin_sequential(sequential)
+        assert read_table(basin['results_path']) == read_table(sequential['results_path'])
+
+
+def run_or_die(job, data=None, dates=None):
+    """
+    Job whose worker process dies in the first months job of North once and of South in every attempt.
+    """
+    marker = os.environ['DIED_ONCE']
+    if job['kind'] == 'months' and job['rows'][0] == 0:
+        if job['name'] == 'South' or not os.path.exists(marker):
+            open(marker, 'w').close()
+            os._exit(1)
+    return RUN_JOB(job, data, dates)
+
+
+RUN_JOB = sb.run_job
+
+
+def test_broken_pool_restarts_jobs_and_saves_report(tmp_path, basins, monkeypatch):
+    monkeypatch.setenv('DIED_ONCE', str(tmp_path / 'died_once'))
+    monkeypatch.setattr(sb, 'run_job', run_or_die)
+    report_path = str(tmp_path / 'batch_report.txt')
+    report = {basin['Basin']: basin for basin in sb.run_batch(basins, 1, 0, report_path)}  # One job at a time
+    assert report['North']['Status'] == 'done'
+    assert report['South']['Status'] == 'failed'
+    assert 'terminated abruptly' in report['South']['Error']
+    with open(report_path) as f:
+        assert 'Basins done: 1 of 2' in f.read()
+
+
+def test_report_is_saved_if_the_batch_stops(tmp_path, basins, monkeypatch):
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(sb.concurrent.futures, 'wait', interrupt)
+    report_path = str(tmp_path / 'batch_report.txt')
+    with pytest.raises(KeyboardInterrupt):
+        sb.run_batch(basins, 2, 0, report_path)
+    with open(report_path) as f:
+        assert f.read().count('stopped') == 2
+
+
+def test_apply_settings_removes_optional_settings_of_last_basin(basins):
+    seasonal, constant = basins
+    sb.apply_settings(constant)
+    assert fs.cp_path == 'South_C.tif'
+
+    sb.apply_settings(seasonal)
+    assert not hasattr(fs, 'cp_path') and not hasattr(config, 'cp_path')
+    assert fs.c_winter_path == 'North_C_winter.tif'
+    assert fs.get_factor_schedule()['C'][0][2] == 'North_C_winter.tif'
+
+
+def test_projections_are_only_checked_in_the_main_process(tmp_path, basins, monkeypatch):
+    # The C factor of North has another projection: the user continues in the main process, the workers have no input
+    main_pid = os.getpid()
+    answers = []
+
+    def answer_in_main_process(message):
+        if os.getpid() != main_pid:
+            raise EOFError('EOF when reading a line')
+        answers.append(message)
+        return '1'
+
+    monkeypatch.setattr(rc, 'check_input_rasters', CHECK_INPUT_RASTERS)
+    monkeypatch.setattr(rc, 'get_raster_data', lambda path: (GT, 'OTHER' if 'North_C' in path else 'PROJ'))
+    monkeypatch.setattr('builtins.input', answer_in_main_process)
+    for basin in basins:
+        basin['pixel_area'] = GT[1] ** 2 / 10000
+    report = sb.run_batch(basins, 2, 0, str(tmp_path / 'batch_report.txt'))
+    assert [basin['Status'] for basin in report] == ['done', 'done'], report
+    assert len(answers) == 2  # Winter and summer C factor of North
+
+
+CHECK_INPUT_RASTERS = rc.check_input_rasters
+
+
+def test_job_memory_of_float32_rasters(basins):
+    settings = dict(basins[1], output_mode='clip')
+    n_pixels = 1024 ** 2
+    assert sb.estimate_job_memory(settings, 'prepare', n_pixels, 2) == 2 * 5  # TT and SDR, 5 bytes per pixel
@@ -0,0 +1,42 @@
+"""
+Tests of the Monte Carlo ensemble (sysl_ensemble.py).
+"""
+import numpy as np
+import pytest
+
+import sysl_ensemble as se
+from conftest import SHAPE, raster_to_array
+
+
+@pytest.fixture
+def ensemble_inputs(monkeypatch):
+    monkeypatch.setattr(se, 'r_pixel_noise_cv', 0.3)
+    monkeypatch.setattr(se, 'k_pixel_noise_cv', 0.1)
+    monkeypatch.setattr(se, 'k_noise_cv', 0.1)
+    r_array = raster_to_array('Rfactor_201601.tif')
+    static_array = raster_to_array('static.tif')
+    factors = {'TT': raster_to_array('tt.tif')}
+    masks = np.full((2,) + SHAPE, True)
+    masks[1, 5:, :] = False
+    return r_array, static_array, factors, se.sample_beta(40, 0.5, 0.05, 7), masks
+
+
+def test_results_do_not_depend_on_batch_size(ensemble_inputs):
+    results = [se.calculate_ensemble_month(*ensemble_inputs, 7, 3, batch_size, [5, 50, 95])
+               for batch_size in [40 * SHAPE[1], 40 * SHAPE[1] * 5, 10 ** 9]]
+    for result in results[1:]:
+        for expected, value in zip(results[0], result):
+            np.testing.assert_allclose(value, expected, rtol=1e-5)
+
+
+def test_r_multiplier_spreads_catchment_totals(ensemble_inputs, monkeypatch):
+    monkeypatch.setattr(se, 'r_pixel_noise_cv', 0.0)
+    monkeypatch.setattr(se, 'k_pixel_noise_cv', 0.0)
+    monkeypatch.setattr(se, 'k_noise_cv', 0.0)
+    monkeypatch.setattr(se, 'r_noise_cv', 0.2)
+    r_array, static_array, factors, betas, masks = ensemble_inputs
+    betas = np.full(4000, 0.5, dtype=np.float32)
+    sl_mean, sy_total, sy_count, sy_quantiles = se.calculate_ensemble_month(
+        r_array, static_array, factors, betas, masks, 7, 0, 10 ** 9, None)
+    # With the same beta for all members, the spread of the totals is the spread of the R factor multiplier
+    assert np.std(sy_total[:, 0]) / np.mean(sy_total[:, 0]) == pytest.approx(0.2, rel=0.1)
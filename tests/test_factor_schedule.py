@@ -0,0 +1,50 @@
+"""
+Tests of the factor schedules and the factor cache (sysl_factor_schedule.py).
+"""
+import numpy as np
+import pytest
+
+import sysl_factor_schedule as fs
+import sysl_raster_calculations as rc
+import sysl_scenarios as ss
+from conftest import SHAPE
+
+MONTHS = [f'2016{month:02d}' for month in range(1, 13)] + [f'2017{month:02d}' for month in range(1, 13)]
+ARRAY_MB = SHAPE[0] * SHAPE[1] * 5 / 1024 ** 2  # Masked float32 array
+
+
+def get_schedule(c_entries, p_path='P.tif'):
+    return {'C': c_entries, 'K': [(None, None, 'K.tif')], 'P': [(None, None, p_path)], 'LS': [(None, None, 'LS.tif')]}
+
+
+def test_time_invariant_factors_are_read_once(fake_rasters):
+    # Monthly C factor rasters and a cache which only fits one array
+    schedule = get_schedule([(month, month, f'C_{month}.tif') for month in MONTHS])
+    cache = fs.create_factor_cache(ARRAY_MB)
+    for month in MONTHS + MONTHS:
+        product = fs.get_static_factors(schedule, cache, month)
+        expected = (rc.raster_to_array(f'C_{month}.tif') * rc.raster_to_array('K.tif') *
+                    rc.raster_to_array('P.tif') * rc.raster_to_array('LS.tif'))
+        np.testing.assert_allclose(product.filled(np.nan), expected.filled(np.nan), rtol=1e-6)
+    assert cache['reads']['K.tif'] == cache['reads']['P.tif'] == cache['reads']['LS.tif'] == 1
+    assert cache['reads']['C_201601.tif'] == 2
+
+
+def test_scenario_products_stay_in_cache(fake_rasters):
+    # Seasonal C factor and one P factor for each scenario, evaluated one after the other in each month
+    schedules = {name: get_schedule([('10', '03', f'C_winter_{name}.tif'), ('04', '09', f'C_summer_{name}.tif')],
+                                    f'P_{name}.tif') for name in ['A', 'B', 'C', 'D']}
+    needed_mb = ss.check_scenario_cache(schedules, SHAPE, 1024)
+    cache = fs.create_factor_cache(needed_mb)
+    for month in MONTHS:
+        for name in schedules:
+            fs.get_static_factors(schedules[name], cache, month)
+    # Each seasonal raster is read once for each season (3 winters and 2 summers), the other rasters only once
+    for name in schedules:
+        assert cache['reads'][f'C_winter_{name}.tif'] == 3
+        assert cache['reads'][f'C_summer_{name}.tif'] == 2
+        assert cache['reads'][f'P_{name}.tif'] == 1
+    assert cache['reads']['K.tif'] == 1
+
+    with pytest.raises(SystemExit, match='factor_cache_mb'):
+        ss.check_scenario_cache(schedules, SHAPE, needed_mb * 0.9)
@@ -0,0 +1,19 @@
+"""
+Tests of the raster calculations in sysl_functions.py.
+"""
+import numpy as np
+
+import sysl_functions as r_calc
+
+
+def test_mask_sums_of_float32_values_are_float64():
+    rng = np.random.default_rng(0)
+    values = rng.random((2, 2000000)).astype(np.float32)
+    values[:, ::7] = np.nan
+    masks = np.vstack([np.full(values.shape[1], True), np.arange(values.shape[1]) % 3 == 0])
+    sums, counts = r_calc.calculate_mask_sums(values, masks)
+    assert sums.dtype == np.float64
+    for k in range(0, masks.shape[0]):
+        expected = np.nansum(values[:, masks[k]].astype(np.float64), axis=1)
+        np.testing.assert_allclose(sums[:, k], expected, rtol=1e-12)
+        np.testing.assert_array_equal(counts[:, k], (~np.isnan(values[:, masks[k]])).sum(axis=1))
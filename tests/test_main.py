@@ -0,0 +1,92 @@
+"""
+Tests of the virtual catchment rasters (output_mode 'vrt') and the saved catchment masks of sysl_main.py.
+"""
+import os
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import pytest
+
+import sysl_main as sysl
+from conftest import GT, SHAPE, create_inputs, get_shape_mask, raster_to_array
+
+
+@pytest.fixture
+def catchments(tmp_path, fake_rasters, monkeypatch):
+    """
+    Creates one R factor raster and two clipping shapes and sets the results folder.
+    """
+    r_folder, clip_path = create_inputs(str(tmp_path), 1)
+    monkeypatch.setattr(sysl, 'results_path', str(tmp_path / 'results'))
+    monkeypatch.setattr(sysl, 'calc_bed_load', False)
+    sysl.fm.check_folder(sysl.results_path, additional_folders=False)
+    return sysl.get_input_files(r_folder, clip_path, sysl.fm.get_date('201601'), sysl.fm.get_date('201601'))
+
+
+def read_vrt(vrt_path):
+    """
+    Calculates the values of a virtual raster saved by save_window_vrt: the product of its sources.
+    """
+    root = ElementTree.parse(vrt_path).getroot()
+    band = root.find('VRTRasterBand')
+    assert band.find('PixelFunctionType').text == 'mul'
+    values = np.ones((int(root.get('rasterYSize')), int(root.get('rasterXSize'))))
+    sources = []
+    for source in [child for child in band if child.tag in ['SimpleSource', 'ComplexSource']]:
+        filename = source.find('SourceFilename')
+        assert filename.get('relativeToVRT') == '1' and not os.path.isabs(filename.text)
+        path = os.path.normpath(os.path.join(os.path.dirname(vrt_path), filename.text))
+        rect = {key: int(value) for key, value in source.find('SrcRect').attrib.items()}
+        array = raster_to_array(path).filled(np.nan)[rect['yOff']:rect['yOff'] + rect['ySize'],
+                                                      rect['xOff']:rect['xOff'] + rect['xSize']]
+        if source.tag == 'ComplexSource':
+            array = array * float(source.find('ScaleRatio').text) + float(source.find('ScaleOffset').text)
+        values = values * array
+        sources.append(path)
+    geotransform = tuple(float(v) for v in root.find('GeoTransform').text.split(','))
+    return values, sources, geotransform
+
+
+def test_virtual_rasters_read_the_catchment_window(catchments):
+    r_files, clip_files = catchments
+    factors, gt, proj = sysl.read_factors(r_files[0], save_sdr=False)
+    sysl.create_result_folders(clip_files)
+    windows = sysl.get_catchment_windows(clip_files, gt, proj, factors['TT'].shape)
+    data = sysl.create_summary_array(len(clip_files), 1)
+    total_path = os.path.join(sysl.results_path, 'Total')
+    sysl.calculate_month(r_files[0], 0, data, factors, clip_files, gt, proj, total_path, catchment_windows=windows)
+
+    mask = get_shape_mask(SHAPE)
+    r0, r1, c0, c1 = 2, 9, 3, 12  # Window of the fake shapes (see conftest)
+    cutline = os.path.join(sysl.results_path, 'Masks', 'Cutline_A.tif')
+    for variable, name, total in [('SL', 'SL_201601_A', 'SL/SL_Banja_201601_Total.tif'),
+                                  ('SY', 'SY_201601_A', 'SY/SY_Banja_201601.tif'),
+                                  ('SY_Total', 'SYTot_201601_A', 'SY/SY_Banja_201601.tif')]:
+        values, sources, geotransform = read_vrt(os.path.join(sysl.results_path, 'A', variable, name + '.vrt'))
+        assert sources[0] == os.path.join(total_path, total) and sources[1] == cutline
+        assert geotransform == (GT[0] + c0 * GT[1], GT[1], 0.0, GT[3] + r0 * GT[5], 0.0, GT[5])
+
+        window = raster_to_array(os.path.join(total_path, total)).filled(np.nan)[r0:r1, c0:c1]
+        inside = mask[r0:r1, c0:c1] & ~np.isnan(window)
+        assert np.array_equal(~np.isnan(values), inside)
+        if variable == 'SY_Total':  # Total SY of the catchment in every pixel of the catchment
+            assert np.allclose(values[inside], data[1, 0, 2])
+            assert np.isclose(np.nanmean(values), data[1, 0, 2])
+        else:
+            assert np.array_equal(values[inside], window[inside])
+            assert np.isclose(np.nanmean(values), data[1, 0, ['SL', 'SY'].index(variable)])
+
+
+def test_saved_masks_are_only_used_on_the_same_grid(catchments):
+    r_files, clip_files = catchments
+    windows = sysl.get_catchment_windows(clip_files, GT, 'PROJ', SHAPE)
+    assert windows[0]['window'] == (2, 9, 3, 12)
+
+    # The results folder is used again with input rasters on another grid
+    gt = (GT[0] + 50, GT[1], 0.0, GT[3], 0.0, GT[5])
+    masks = sysl.get_catchment_masks(clip_files, gt, (10, 14))
+    assert masks.shape == (3, 10, 14)
+    windows = sysl.get_catchment_windows(clip_files, gt, 'PROJ', (10, 14))
+    cutline = os.path.join(sysl.results_path, 'Masks', 'Cutline_A.tif')
+    assert sysl.rc.get_raster_data(cutline)[0] == (gt[0] + 3 * GT[1], GT[1], 0.0, GT[3] + 2 * GT[5], 0.0, GT[5])
+    assert windows[0]['window'] == (2, 9, 3, 12)
@@ -0,0 +1,106 @@
+"""
+Tests of the zonal queries from the summed-area tables and the rasterized polygons (sysl_query.py).
+"""
+import http.client
+import http.server
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import sysl_query as sq
+import sysl_raster_calculations as rc
+from conftest import GT, SHAPE, save_raster
+
+
+@pytest.fixture
+def stacks(tmp_path, fake_rasters):
+    """
+    Saves 3 months of SY rasters with some no data pixels and builds their stacks.
+    """
+    rng = np.random.default_rng(1)
+    arrays = []
+    for month in range(1, 4):
+        array = rng.random(SHAPE).astype(np.float32)
+        array[month, :5] = np.nan
+        raster = os.path.join(tmp_path, 'Total', 'SY', f'SY_Banja_2016{month:02d}.tif')
+        save_raster(array, raster, GT, 'PROJ')
+        arrays.append(array)
+    sq.build_stacks(str(tmp_path), ['SY'])
+    stacks = sq.open_stacks(str(tmp_path))
+    stacks['arrays'] = arrays
+    return stacks
+
+
+def ring(r0, r1, c0, c1):
+    """
+    Closed ring along the pixel edges of rows r0 to r1 - 1 and columns c0 to c1 - 1.
+    """
+    x0, x1 = GT[0] + c0 * GT[1], GT[0] + c1 * GT[1]
+    y0, y1 = GT[3] + r0 * GT[5], GT[3] + r1 * GT[5]
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]
+
+
+def check_result(result, arrays, mask):
+    for i, array in enumerate(arrays):
+        values = array[mask].astype(np.float64)
+        assert result['count'][i] == np.count_nonzero(~np.isnan(values))
+        np.testing.assert_allclose(result['total'][i], np.nansum(values), rtol=1e-9)
+        np.testing.assert_allclose(result['mean'][i], np.nanmean(values), rtol=1e-6)
+
+
+def test_bbox_query_matches_window_sums(stacks):
+    assert stacks['count']['SY'].dtype == np.int64
+
+    # Pixel centers of rows 1-6 and columns 2-9
+    bbox = (GT[0] + 2 * GT[1], GT[3] + 7 * GT[5], GT[0] + 10 * GT[1], GT[3] + 1 * GT[5])
+    result = sq.query(stacks, 'SY', bbox=bbox)
+    assert result['dates'] == ['201601', '201602', '201603']
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[1:7, 2:10] = True
+    check_result(result, stacks['arrays'], mask)
+
+
+def test_polygon_query_matches_bbox_query(stacks):
+    bbox = (GT[0] + 2 * GT[1], GT[3] + 7 * GT[5], GT[0] + 10 * GT[1], GT[3] + 1 * GT[5])
+    polygon = {'type': 'Polygon', 'coordinates': [ring(1, 7, 2, 10)]}
+    assert sq.query(stacks, 'SY', geometry=polygon) == sq.query(stacks, 'SY', bbox=bbox)
+
+
+def test_polygon_with_hole_and_cached_mask(stacks, monkeypatch):
+    feature = {'type': 'Feature', 'geometry': {'type': 'MultiPolygon', 'coordinates': [
+        [ring(1, 7, 2, 10), ring(3, 5, 4, 7)], [ring(9, 11, 12, 15)]]}}
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[1:7, 2:10] = True
+    mask[3:5, 4:7] = False  # Hole
+    mask[9:11, 12:15] = True
+    result = sq.query(stacks, 'SY', geometry=feature)
+    check_result(result, stacks['arrays'], mask)
+
+    # The second query uses the rasterized mask of the cache
+    def not_rasterized(*args):
+        raise AssertionError('The polygon was rasterized again.')
+
+    monkeypatch.setattr(rc, 'rasterize_polygons', not_rasterized)
+    assert sq.query(stacks, 'SY', geometry=feature) == result
+    assert len(stacks['cache']['items']) == 1
+
+
+def test_invalid_requests_get_an_error_answer(stacks):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), sq.create_handler(stacks))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        for body in ['[1, 2]', '{"geometry": "abc"}', '{"geometry": {"type": "Feature", "geometry": 1}}',
+                     '{"geometry": {"type": "Polygon", "coordinates": "abc"}}', '{"bbox": 5}', 'not json']:
+            connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=10)
+            connection.request('POST', '/query', body=body)
+            response = connection.getresponse()
+            assert response.status == 400, body
+            assert 'error' in json.loads(response.read())
+            connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,94 @@
+"""
+Tests of the raster reading in sysl_raster_calculations.py.
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import sysl_factor_schedule as fs
+import sysl_raster_calculations as rc
+
+PATHS = [f'R_{i}.tif' for i in range(0, 8)]
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """
+    Replaces raster_to_array with a stub which returns the index of the raster and records the rasters read.
+    """
+    reads = []
+
+    def read(raster_path):
+        if raster_path == 'exit.tif':
+            raise SystemExit("ERROR: The raster exit.tif can not be read.")
+        if raster_path == 'broken.tif':
+            raise ValueError("broken.tif is not a valid raster.")
+        reads.append(raster_path)
+        return np.ma.masked_invalid(np.full((2, 2), PATHS.index(raster_path), dtype=np.float32))
+
+    monkeypatch.setattr(rc, 'raster_to_array', read)
+    return reads
+
+
+def wait_for_reads(reads, n_reads):
+    """
+    Waits until the background thread read n_reads rasters (or 5 seconds), and a bit longer to see if it reads more.
+    """
+    deadline = time.time() + 5
+    while len(reads) < n_reads and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+
+
+def prefetch_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'raster_prefetch']
+
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_rasters_are_yielded_in_order(reads, depth):
+    result = [(path, int(array[0, 0])) for path, array in rc.prefetch_rasters(PATHS, depth)]
+    assert result == [(path, i) for i, path in enumerate(PATHS)]
+    assert reads == PATHS
+    assert prefetch_threads() == []
+
+
+@pytest.mark.parametrize('depth', [1, 2])
+def test_at_most_depth_arrays_are_read_ahead(reads, depth):
+    rasters = rc.prefetch_rasters(PATHS, depth)
+    for n_used in range(1, len(PATHS) + 1):
+        next(rasters)
+        # 'depth' arrays wait in the buffer and the reader holds the next one until there is space
+        wait_for_reads(reads, min(n_used + depth + 1, len(PATHS)))
+        assert len(reads) == min(n_used + depth + 1, len(PATHS))
+    rasters.close()
+
+
+@pytest.mark.parametrize('depth', [0, 2])
+@pytest.mark.parametrize('failing, error', [('exit.tif', SystemExit), ('broken.tif', ValueError)])
+def test_errors_are_raised_at_the_failing_raster(reads, depth, failing, error):
+    paths = PATHS[0:3] + [failing] + PATHS[3:]
+    used = []
+    with pytest.raises(error, match=failing):
+        for path, array in rc.prefetch_rasters(paths, depth):
+            used.append(path)
+    assert used == PATHS[0:3]
+    assert reads == PATHS[0:3]  # No raster after the failing one is read
+    assert prefetch_threads() == []
+
+
+def test_closing_the_generator_stops_the_reader(reads):
+    rasters = rc.prefetch_rasters(PATHS, 2)
+    next(rasters)
+    wait_for_reads(reads, 4)
+    rasters.close()
+    assert prefetch_threads() == []
+    assert len(reads) == 4
+    time.sleep(0.2)
+    assert len(reads) == 4
+
+
+def test_pixel_bytes_of_masked_arrays():
+    array = rc.create_masked_array(np.float32(np.arange(0, 12).reshape(3, 4)), np.float32(-9999))
+    assert fs.get_array_bytes(array) == array.size * rc.PIXEL_BYTES == 12 * 5
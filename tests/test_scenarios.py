@@ -0,0 +1,54 @@
+"""
+Tests of the land management scenarios (sysl_scenarios.py).
+"""
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import sysl_main as sysl
+import sysl_scenarios as sc
+from conftest import create_inputs, run_sequential
+
+
+@pytest.fixture
+def inputs(tmp_path, fake_rasters, monkeypatch):
+    """
+    Creates the input files (3 months, 2 catchments) and sets the results folder.
+    """
+    r_folder, clip_path = create_inputs(str(tmp_path), 3)
+    for module in [sysl, sc]:
+        monkeypatch.setattr(module, 'results_path', str(tmp_path / 'results'))
+    monkeypatch.setattr(sysl, 'output_mode', 'vrt')
+    monkeypatch.setattr(sc, 'prefetch_depth', 0)
+    sysl.fm.check_folder(sysl.results_path, additional_folders=False)
+    return sysl.get_input_files(r_folder, clip_path, sysl.fm.get_date('201601'), sysl.fm.get_date('201603'))
+
+
+def test_current_scenario_matches_main_run(inputs):
+    r_files, clip_files = inputs
+    scenarios = {'Current': {}, 'Reforestation': {'cp_path': 'Reforestation_C.tif'}}
+    data, dates = sc.run_scenarios(r_files, clip_files, scenarios, {'Reforestation': ['SY']})
+    assert list(dates[:, 0]) == ['201601', '201602', '201603']
+
+    sysl.create_result_folders(clip_files)
+    data_summary, dates_vector = run_sequential(r_files, clip_files)
+    np.testing.assert_allclose(data[:, 0], data_summary, rtol=1e-6)
+    assert not np.allclose(data[:, 1], data_summary)
+    saved = glob.glob(os.path.join(sysl.results_path, 'Scenarios', 'Reforestation', 'SY', '*.tif'))
+    assert len(saved) == 3
+
+
+@pytest.mark.parametrize('scenarios, save_rasters, error', [
+    ({'Reforestation': {'cp_Path': 'C.tif'}}, {}, 'unknown settings: cp_Path'),
+    ({'Reforestation': {'c_path': 'C.tif'}}, {}, 'unknown settings: c_path'),
+    ({'Reforestation': {'cp_path': 'C.tif', 'c_winter_path': 'C_winter.tif'}}, {}, 'Use only one'),
+    ({'Terracing': {'schedule': {'PP': [(None, None, 'P.tif')]}}}, {}, 'unknown factors: PP'),
+    ({'Current': {}}, {'Current': ['Bogus']}, 'unknown rasters: Bogus'),
+    ({'Current': {}}, {'Curent': ['SY']}, 'Curent'),
+])
+def test_unknown_scenario_settings_stop_the_run(inputs, scenarios, save_rasters, error):
+    r_files, clip_files = inputs
+    with pytest.raises(SystemExit, match=error):
+        sc.run_scenarios(r_files, clip_files, scenarios, save_rasters)
@@ -0,0 +1,221 @@
+"""
+Tests of the sharded execution (sysl_sharding.py) with several local worker processes.
+"""
+import glob
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pytest
+
+import sysl_file_management as fm
+import sysl_main as sysl
+import sysl_raster_calculations as rc
+import sysl_sharding as ss
+import sysl_statistics as st
+from conftest import GT, SHAPE, create_inputs, run_sequential
+
+START, END = '201601', '201607'
+
+
+@pytest.fixture
+def plan_queue(tmp_path, fake_rasters, monkeypatch):
+    """
+    Creates the input files (7 months, 2 catchments) in a temporary folder and returns a function which plans the work
+    units (2 months each) with an output mode and number of catchments per unit.
+    """
+    def plan(mode='vrt', n_catchments=0):
+        r_folder, clip_path = create_inputs(str(tmp_path), 7)
+        results_path = str(tmp_path / 'results')
+        for module in [sysl, ss]:
+            monkeypatch.setattr(module, 'results_path', results_path)
+            monkeypatch.setattr(module, 'output_mode', mode)
+        monkeypatch.setattr(ss, 'prefetch_depth', 0)
+
+        start_date, end_date = fm.get_date(START), fm.get_date(END)
+        r_filenames, clip_filenames = sysl.get_input_files(r_folder, clip_path, start_date, end_date)
+        fm.check_folder(results_path, additional_folders=False)
+        factors, gt, proj = sysl.read_factors(r_filenames[0], save_sdr=True)
+        sysl.create_result_folders(clip_filenames)
+        if mode == 'vrt':
+            sysl.get_catchment_windows(clip_filenames, gt, proj, factors['TT'].shape)
+        queue = str(tmp_path / 'queue')
+        ss.plan_work_units(queue, r_filenames, clip_filenames, start_date, end_date, 2, n_catchments)
+        return queue
+    return plan
+
+
+@pytest.fixture
+def queue_path(plan_queue):
+    return plan_queue()
+
+
+def run_plan_sequential(queue):
+    """
+    Calculates all months of the plan in one process and returns the summary array.
+    """
+    plan = ss.read_plan(queue)
+    return run_sequential(plan['r_files'], plan['clip_files'])[0]
+
+
+def start_workers(target, args_list):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    return [process.exitcode for process in processes]
+
+
+def die_after_first_month(queue):
+    """
+    Worker which claims a work unit and dies after its first month, without releasing the lease.
+    """
+    calculate_month = sysl.calculate_month
+
+    def calculate_and_die(*args, **kwargs):
+        calculate_month(*args, **kwargs)
+        os._exit(1)
+
+    sysl.calculate_month = calculate_and_die
+    ss.run_worker(queue, 'dying', 3600)
+
+
+def test_workers_merge_to_sequential_results(queue_path):
+    exit_codes = start_workers(ss.run_worker, [(queue_path, f'worker_{j}', 3600) for j in range(0, 3)])
+    assert exit_codes == [0, 0, 0]
+    assert os.listdir(os.path.join(queue_path, 'leases')) == []
+
+    data_summary, dates_vector, clip_filenames = ss.merge_partial_results(queue_path)
+    assert list(dates_vector[:, 0]) == [f'2016{month:02d}' for month in range(1, 8)]
+    np.testing.assert_allclose(data_summary, run_plan_sequential(queue_path))
+
+
+def test_dead_worker_unit_is_claimed_after_lease_expires(queue_path):
+    assert start_workers(die_after_first_month, [(queue_path,)]) == [1]
+    lock_file = os.path.join(queue_path, 'leases', 'unit_00000.lock')
+    assert os.path.exists(lock_file)
+
+    # The lease is still valid: the other units are calculated, but the merge is not complete
+    assert ss.run_worker(queue_path, 'worker', 3600) == 3
+    with pytest.raises(SystemExit, match='unit_00000'):
+        ss.merge_partial_results(queue_path)
+
+    # Once the lease is expired, the unit is claimed again
+    os.utime(lock_file, (time.time() - 7200, time.time() - 7200))
+    assert start_workers(ss.run_worker, [(queue_path, 'worker_0', 3600), (queue_path, 'worker_1', 3600)]) == [0, 0]
+    data_summary, dates_vector, clip_filenames = ss.merge_partial_results(queue_path)
+    np.testing.assert_allclose(data_summary, run_plan_sequential(queue_path))
+
+
+def test_expired_lease_is_broken_once(queue_path, monkeypatch):
+    lock_file = os.path.join(queue_path, 'leases', 'unit_00000.lock')
+    assert ss.create_lock(lock_file, 'old token')
+    os.utime(lock_file, (time.time() - 7200, time.time() - 7200))
+    expired = ss.read_lock(lock_file)
+
+    # Another worker broke the lease and claimed the unit after this worker read the expired lock file
+    os.remove(lock_file)
+    assert ss.create_lock(lock_file, 'new token')
+    read_lock = ss.read_lock
+    reads = []
+
+    def read_expired_first(path):
+        reads.append(path)
+        return expired if len(reads) == 1 else read_lock(path)
+
+    monkeypatch.setattr(ss, 'read_lock', read_expired_first)
+    ss.break_expired_lease(lock_file, 'late_worker', 3600)
+    monkeypatch.setattr(ss, 'read_lock', read_lock)
+    assert ss.read_lock(lock_file)[0] == 'new token'
+    assert os.listdir(os.path.join(queue_path, 'leases')) == ['unit_00000.lock']
+
+
+def test_lease_is_only_renewed_and_released_with_its_token(queue_path):
+    unit = ss.claim_work_unit(queue_path, 'worker_0', 3600)
+    lock_file = os.path.join(queue_path, 'leases', unit['name'] + '.lock')
+    assert ss.renew_lease(queue_path, unit['name'], unit['token'])
+
+    # The lease expired and was claimed by another worker
+    os.utime(lock_file, (time.time() - 7200, time.time() - 7200))
+    other = ss.claim_work_unit(queue_path, 'worker_1', 3600)
+    assert other['name'] == unit['name'] and other['token'] != unit['token']
+    assert not ss.renew_lease(queue_path, unit['name'], unit['token'])
+    ss.release_lease(queue_path, unit['name'], unit['token'])
+    assert ss.read_lock(lock_file)[0] == other['token']
+
+
+def test_merge_fails_for_missing_months(queue_path):
+    assert ss.run_worker(queue_path, 'worker', 3600) == 4
+    plan = ss.read_plan(queue_path)
+
+    # The months are checked against the analysis date range, not against the planned R factor rasters
+    plan_file = os.path.join(queue_path, 'plan.json')
+    with open(plan_file) as f:
+        text = f.read()
+    with open(plan_file, 'w') as f:
+        f.write(text.replace('"end_date": "201607"', '"end_date": "201608"'))
+    with pytest.raises(SystemExit, match='Missing: 201608'):
+        ss.merge_partial_results(queue_path)
+    with open(plan_file, 'w') as f:
+        f.write(text)
+
+    # A partial result which does not cover its months
+    partial_file = os.path.join(queue_path, 'partial', plan['units'][1] + '.npz')
+    with np.load(partial_file) as partial:
+        data = {name: partial[name] for name in partial.files}
+    data['catchments'] = data['catchments'][:1]
+    data['data'] = data['data'][:2]
+    with open(partial_file, 'wb') as f:
+        np.savez(f, **data)
+    with pytest.raises(SystemExit, match='cover 5 of 7'):
+        ss.merge_partial_results(queue_path)
+
+    os.remove(partial_file)
+    with pytest.raises(SystemExit, match='not finished'):
+        ss.merge_partial_results(queue_path)
+
+
+def test_merge_calculates_statistics_from_saved_rasters(queue_path):
+    assert ss.run_worker(queue_path, 'worker', 3600) == 4
+    data_summary, dates_vector, clip_filenames = ss.merge_partial_results(queue_path)
+    st.save_result_statistics(sysl.results_path, list(dates_vector[:, 0]), {'SL': [0.5], 'SY': []}, [50], 1)
+
+    # Statistics of the accumulators of a sequential run
+    accumulators = {'SL': st.create_accumulator(SHAPE, [0.5], [50]), 'SY': st.create_accumulator(SHAPE, [], [50])}
+    run_sequential(ss.read_plan(queue_path)['r_files'], [], os.path.join(sysl.results_path, 'Check'), accumulators)
+    for name, acc in accumulators.items():
+        for statistic, array in st.get_statistics(acc).items():
+            saved = rc.raster_to_array(os.path.join(sysl.results_path, 'Statistics', f'{name}_{statistic}.tif'))
+            np.testing.assert_allclose(saved.filled(np.nan), array, rtol=1e-5, equal_nan=True)
+
+
+def test_workers_do_not_ask_about_projections(queue_path, monkeypatch):
+    # The factor rasters have another projection, which the user accepted when the work units were planned
+    def no_input(message):
+        raise EOFError('EOF when reading a line')
+
+    monkeypatch.setattr(rc, 'check_input_rasters', CHECK_INPUT_RASTERS)
+    monkeypatch.setattr(rc, 'get_raster_data', lambda path: (GT, 'PROJ' if 'Rfactor' in path else 'OTHER'))
+    monkeypatch.setattr(sysl, 'pixel_area', GT[1] ** 2 / 10000)
+    monkeypatch.setattr('builtins.input', no_input)
+    assert start_workers(ss.run_worker, [(queue_path, 'worker_0', 3600), (queue_path, 'worker_1', 3600)]) == [0, 0]
+    data_summary, dates_vector, clip_filenames = ss.merge_partial_results(queue_path)
+    assert list(dates_vector[:, 0]) == [f'2016{month:02d}' for month in range(1, 8)]
+
+
+CHECK_INPUT_RASTERS = rc.check_input_rasters
+
+
+def test_catchment_sets_in_clip_mode(plan_queue):
+    # Units of the second catchment set save the total catchment rasters to a scratch folder, which is deleted
+    queue = plan_queue('clip', 1)
+    assert len(os.listdir(os.path.join(queue, 'units'))) == 8
+    assert start_workers(ss.run_worker, [(queue, f'worker_{j}', 3600) for j in range(0, 2)]) == [0, 0]
+    assert os.listdir(os.path.join(queue, 'scratch')) == []
+    assert len(glob.glob(os.path.join(sysl.results_path, 'B', 'SY', '*.tif'))) == 7
+
+    data_summary, dates_vector, clip_filenames = ss.merge_partial_results(queue)
+    np.testing.assert_allclose(data_summary, run_plan_sequential(queue))
@@ -0,0 +1,102 @@
+"""
+Tests of the online statistics of each pixel in sysl_statistics.py.
+"""
+import warnings
+
+import numpy as np
+import pytest
+
+import sysl_statistics as st
+
+
+def p2_quantile(values, p):
+    """
+    Scalar P-square estimate of a quantile (Jain and Chlamtac, 1985) of a series with more than 5 values.
+    """
+    q = sorted(values[0:5])
+    pos = [1, 2, 3, 4, 5]
+    desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+    increment = [0, p / 2, p, (1 + p) / 2, 1]
+    for x in values[5:]:
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x < q[1]:
+            k = 0
+        elif x < q[2]:
+            k = 1
+        elif x < q[3]:
+            k = 2
+        elif x <= q[4]:
+            k = 3
+        else:
+            q[4] = x
+            k = 3
+        for i in range(k + 1, 5):
+            pos[i] += 1
+        desired = [desired[i] + increment[i] for i in range(0, 5)]
+        for i in range(1, 4):
+            d = desired[i] - pos[i]
+            if (d >= 1 and pos[i + 1] - pos[i] > 1) or (d <= -1 and pos[i - 1] - pos[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = q[i] + d / (pos[i + 1] - pos[i - 1]) * (
+                        (pos[i] - pos[i - 1] + d) * (q[i + 1] - q[i]) / (pos[i + 1] - pos[i])
+                        + (pos[i + 1] - pos[i] - d) * (q[i] - q[i - 1]) / (pos[i] - pos[i - 1]))
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] = q[i] + d * (q[i + d] - q[i]) / (pos[i + d] - pos[i])
+                pos[i] += d
+    return q[2]
+
+
+@pytest.fixture
+def months():
+    """
+    60 months of lognormal values of 5 x 6 pixels with random no data gaps, a pixel without values and pixels with
+    1, 3 and 5 values.
+    """
+    rng = np.random.default_rng(3)
+    values = rng.lognormal(0, 1, (60, 5, 6))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    values[:, 0, 0] = np.nan
+    values[:, 0, 1:4] = np.nan
+    values[0, 0, 1] = 1.5
+    values[0:3, 0, 2] = [0.2, 3.1, 1.4]
+    values[0:5, 0, 3] = [2.2, 0.4, 0.9, 5.3, 1.1]
+    return values
+
+
+def accumulate(months, thresholds, quantiles):
+    acc = st.create_accumulator(months.shape[1:], thresholds, quantiles)
+    for array in months:
+        st.update_accumulator(acc, array)
+    return st.get_statistics(acc)
+
+
+def test_moments_max_and_exceedance_match_numpy(months):
+    stats = accumulate(months, [0.5, 2], [])
+    count = np.sum(~np.isnan(months), axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-np.nan pixel
+        np.testing.assert_allclose(stats['mean'], np.nanmean(months, axis=0), rtol=1e-12, equal_nan=True)
+        np.testing.assert_allclose(stats['std'], np.nanstd(months, axis=0, ddof=1), rtol=1e-10, equal_nan=True)
+        np.testing.assert_array_equal(stats['max'], np.nanmax(months, axis=0))
+        for threshold in [0.5, 2]:
+            expected = np.where(count > 0, np.sum(months > threshold, axis=0) / count, np.nan)
+            np.testing.assert_allclose(stats[f'exceed_{threshold:g}'], expected, rtol=1e-12, equal_nan=True)
+    assert np.isnan(stats['std'][0, 1]) and stats['mean'][0, 1] == 1.5
+
+
+def test_quantiles_match_scalar_p2(months):
+    stats = accumulate(months, [], [50, 90])
+    for quantile in [50, 90]:
+        for row, col in np.ndindex(months.shape[1:]):
+            values = months[:, row, col][~np.isnan(months[:, row, col])]
+            result = stats[f'Q{quantile:g}'][row, col]
+            if len(values) == 0:
+                assert np.isnan(result)
+            elif len(values) <= 5:  # Quantile of the stored values
+                assert result == pytest.approx(np.percentile(values, quantile), rel=1e-12)
+            else:
+                assert result == pytest.approx(p2_quantile(list(values), quantile / 100), rel=1e-12)